@@ -0,0 +1,108 @@
+"""Benchmark compiling state definitions for many agents.
+
+Generates a synthetic data tree and compiles every agent's state definition,
+first serially in this process and then with StateCompiler pools of
+increasing size, to show how compilation scales with the number of cores.
+
+Run with: uv run python scripts/benchmark_state_compile.py
+"""
+
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+import yaml
+
+from redpepper.manager.compiler import StateCompiler, list_source_files
+from redpepper.manager.data import DataManager
+
+
+def generate_tree(
+    base_dir: pathlib.Path, agents: int, groups: int, tasks: int
+) -> list[str]:
+    (base_dir / "data").mkdir()
+    (base_dir / "state").mkdir()
+    agent_ids = [f"agent{i}" for i in range(agents)]
+    agents_yml = {
+        agent_id: {"data": {"hostname": f"{agent_id}.example.com", "index": i}}
+        for i, agent_id in enumerate(agent_ids)
+    }
+    groups_yml: dict[str, list[str]] = {"*": ["common"]}
+    for i, agent_id in enumerate(agent_ids):
+        groups_yml[agent_id] = [f"group{i % groups}", f"group{(i * 7) % groups}"]
+    with open(base_dir / "agents.yml", "w") as f:
+        yaml.safe_dump(agents_yml, f)
+    with open(base_dir / "groups.yml", "w") as f:
+        yaml.safe_dump(groups_yml, f)
+    for group in ["common"] + [f"group{i}" for i in range(groups)]:
+        with open(base_dir / "data" / f"{group}.yml", "w") as f:
+            yaml.safe_dump(
+                {"group": group, "settings": {f"key{j}": j for j in range(20)}}, f
+            )
+        state = [
+            {
+                f"{group} section {s}": [
+                    {
+                        f"Task {t}": {
+                            "type": "file.Installed",
+                            "path": "/etc/${group}/${hostname}/" + f"{s}-{t}.conf",
+                            "source": "${group}/" + f"file{t}",
+                            "mode": "${settings.key%d}" % (t % 20),
+                        }
+                    }
+                    for t in range(tasks)
+                ]
+            }
+            for s in range(5)
+        ]
+        with open(base_dir / "state" / f"{group}.yml", "w") as f:
+            yaml.safe_dump(state, f)
+    return agent_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--agents", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--tasks", type=int, default=20, help="Tasks per section")
+    parser.add_argument(
+        "--max-workers", type=int, default=os.cpu_count() or 1, help="Largest pool"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_dir = pathlib.Path(tmp)
+        agent_ids = generate_tree(base_dir, args.agents, args.groups, args.tasks)
+        data_manager = DataManager(base_dir)
+        # Parse all the source files outside of the measurement
+        for path, _, _ in list_source_files(base_dir):
+            data_manager.load_yaml_file(path)
+
+        start = time.perf_counter()
+        for agent_id in agent_ids:
+            data_manager.get_state_definition_for_agent(agent_id)
+        serial = time.perf_counter() - start
+        print(f"{'serial':>10}: {serial:8.2f}s")
+
+        workers = 1
+        while workers <= args.max_workers:
+            compiler = StateCompiler(data_manager, workers)
+            try:
+                # Start the pool outside of the measurement
+                compiler.compile(agent_ids[0])
+                start = time.perf_counter()
+                compiler.compile_many(agent_ids)
+                elapsed = time.perf_counter() - start
+            finally:
+                compiler.shutdown()
+            print(
+                f"{workers:>3} worker{'s' if workers > 1 else ' '}: {elapsed:8.2f}s"
+                f"  ({serial / elapsed:.2f}x serial)"
+            )
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,20 @@
 """RedPepper Agent"""
 
 import base64
+import contextvars
+import copy
+import hashlib
 import importlib.util
 import logging
 import os
 import ssl
 import subprocess
 import traceback
+import zlib
 from collections import OrderedDict
 from typing import Any, Coroutine, Generator, Sequence
 
+import msgpack
 import trio
 
 from redpepper.common.connection import Connection
@@ -21,6 +26,7 @@ from redpepper.common.messages import (
     Notification,
 )
 from redpepper.common.operations import Result
+from redpepper.common.rpc import RPCError
 from redpepper.common.slot import Slot
 from redpepper.version import __version__
 
@@ -29,6 +35,11 @@ from .config import AgentConfig
 logger = logging.getLogger(__name__)
 TRACE = 5
 
+# The state bundle used by the command being run in the current task, if any
+_state_bundle: contextvars.ContextVar[dict | None] = contextvars.ContextVar(
+    "state_bundle", default=None
+)
+
 
 class OperationSpec:
     def __init__(self, name: str, data: dict[str, Any]):
@@ -51,6 +62,7 @@ class Agent:
     def __init__(self, config: AgentConfig):
         self.config = config
         self.data_slots: dict[str, Slot] = {}
+        self.state_bundles: dict[str, dict] = {}
         self.last_message_id = 100
         self.tls_context = config.load_tls_context(ssl.Purpose.SERVER_AUTH)
         self.connected = trio.Event()
@@ -125,18 +137,50 @@ class Agent:
     ) -> None:
         self.conn.trio_nursery.start_soon(self._run_command, id, cmdtype, args, kwargs)
 
+    async def get_state_definition(self, state_name: str) -> tuple[Any, str | None]:
+        """Get a state definition and its fingerprint from the manager.
+        The fingerprint is None if the manager is too old to compute it."""
+        try:
+            data = await self.conn.rpc.call(
+                "custom",
+                "stateDefinition",
+                state_name=state_name,
+                with_fingerprint=True,
+            )
+        except RPCError as e:
+            if "with_fingerprint" not in str(e):
+                raise
+            logger.debug("Manager does not support state fingerprints: %s", e)
+        else:
+            if isinstance(data, dict) and "state" in data:
+                return data["state"], data.get("fingerprint")
+            # The option was ignored, so this is the plain state definition
+            return data, None
+        state_data = await self.conn.rpc.call(
+            "custom", "stateDefinition", state_name=state_name
+        )
+        return state_data, None
+
     async def _run_command(
         self, id: str, cmdtype: str, args: Sequence[Any], kwargs: dict[str, Any]
     ):
+        fingerprint = None
         try:
             commandID = id
             if cmdtype == "state":
                 if len(args) > 1:
                     raise ValueError("State command takes at most one argument")
                 state_name = args[0] if args else ""
-                state_data = await self.conn.rpc.call(
-                    "custom", "stateDefinition", state_name=state_name
-                )
+                if self.config.state_bundles:
+                    bundle = await self.get_state_bundle(state_name)
+                    _state_bundle.set(bundle)
+                    # Running the state modifies the task definitions
+                    state_data = copy.deepcopy(bundle["state"])
+                    fingerprint = bundle["fingerprint"]
+                else:
+                    state_data, fingerprint = await self.get_state_definition(
+                        state_name
+                    )
                 if not isinstance(state_data, list):
                     raise ValueError(f"State {state_name} is not a list")
                 result = await self.run_state(
@@ -166,6 +210,10 @@ class Agent:
                 "output": str(result),
             },
         )
+        if fingerprint is not None and result.succeeded:
+            # Let the manager know which desired state is now applied
+            res.data["state"] = args[0] if args else ""
+            res.data["fingerprint"] = fingerprint
         await self.conn.send_message(res)
 
     async def do_operation(
@@ -198,19 +246,28 @@ class Agent:
             except OSError:
                 mtime = None
                 size = None
-            # Request the operation module status from the manager
-            logger.debug("Requesting operation module %s", module_name)
-            data = await self.conn.rpc.call(
-                "custom",
-                "operationModule",
-                name=module_name,
-                existing_mtime=mtime,
-                existing_size=size,
-            )
-            if data["changed"]:
+            bundle = _state_bundle.get()
+            if bundle is not None and module_name in bundle["modules"]:
+                # The state bundle includes the module
+                data = bundle["modules"][module_name]
+                module_changed = (mtime, size) != (data["mtime"], data["size"])
+                content = data["content"]
+            else:
+                # Request the operation module status from the manager
+                logger.debug("Requesting operation module %s", module_name)
+                data = await self.conn.rpc.call(
+                    "custom",
+                    "operationModule",
+                    name=module_name,
+                    existing_mtime=mtime,
+                    existing_size=size,
+                )
+                module_changed = data["changed"]
+                if module_changed:
+                    content = base64.b64decode(data["content"])
+            if module_changed:
                 logger.debug("Operation module %s has changed", module_name)
                 # Save the module to the cache directory
-                content = base64.b64decode(data["content"])
                 with open(cached_path, "wb") as f:
                     f.write(content)
                 os.utime(cached_path, (data["mtime"], data["mtime"]))
@@ -260,6 +317,80 @@ class Agent:
         logger.debug("Operation result: %s", result)
         return result
 
+    async def get_state_bundle(self, state_name: str) -> dict:
+        """Get the bundle for the state, fetching it from the manager if it has changed."""
+        bundle = self.state_bundles.get(state_name)
+        data = await self.conn.rpc.call(
+            "custom",
+            "stateBundle",
+            state_name=state_name,
+            existing_hash=bundle["hash"] if bundle else None,
+        )
+        if bundle is not None and not data["changed"]:
+            logger.debug("State bundle for %s is unchanged", state_name)
+            return bundle
+        logger.debug("Fetching state bundle %s for %s", data["hash"], state_name)
+        if "content" in data:
+            compressed = base64.b64decode(data["content"])
+        else:
+            chunks = []
+            offset = 0
+            while offset < data["size"]:
+                chunk = base64.b64decode(
+                    await self.conn.rpc.call(
+                        "custom",
+                        "stateBundleContents",
+                        hash=data["hash"],
+                        offset=offset,
+                        length=256 * 1024,
+                    )
+                )
+                if not chunk:
+                    raise ValueError("State bundle ended unexpectedly")
+                chunks.append(chunk)
+                offset += len(chunk)
+            compressed = b"".join(chunks)
+        packed = zlib.decompress(compressed)
+        if hashlib.sha256(packed).hexdigest() != data["hash"]:
+            raise ValueError("State bundle does not match its hash")
+        bundle = msgpack.unpackb(packed)
+        bundle["hash"] = data["hash"]
+        self.state_bundles[state_name] = bundle
+        return bundle
+
+    async def get_data_file_stat(self, name: str) -> dict:
+        """Get the mtime and size of a data file from the manager."""
+        bundle = _state_bundle.get()
+        if bundle is not None and name in bundle["files"]:
+            file = bundle["files"][name]
+            return {"mtime": file["mtime"], "size": file["size"]}
+        return await self.conn.rpc.call("custom", "dataFileStat", path=name)
+
+    async def get_data_file_hash(self, name: str) -> str:
+        """Get the SHA-256 digest of a data file from the manager."""
+        bundle = _state_bundle.get()
+        if bundle is not None and name in bundle["files"]:
+            return bundle["files"][name]["hash"]
+        return await self.conn.rpc.call("custom", "dataFileHash", path=name)
+
+    async def get_data_file_contents(
+        self, name: str, offset: int, length: int
+    ) -> bytes:
+        """Get up to length bytes of a data file from the manager starting at offset."""
+        bundle = _state_bundle.get()
+        if bundle is not None and name in bundle["files"]:
+            content = bundle["files"][name]["content"]
+            if content is not None:
+                return content[offset : offset + length]
+        data = await self.conn.rpc.call(
+            "custom",
+            "dataFileContents",
+            filename=name,
+            offset=offset,
+            length=length,
+        )
+        return base64.b64decode(data)
+
     def _walk_state_tree(
         self, items: list, parents: tuple = ()
     ) -> Generator[tuple[tuple, dict], None, None]:
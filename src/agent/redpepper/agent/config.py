@@ -28,6 +28,9 @@ class AgentConfig(BaseConfig, ConnectionConfig, TLSConfig):
         "/var/lib/redpepper-agent/operations"
     )
 
+    # States
+    state_bundles: bool = False
+
     # Timeouts
     data_request_timeout: int = 5
     hello_timeout: int = 3
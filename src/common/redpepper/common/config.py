@@ -6,6 +6,16 @@ from typing import Any, Self
 import pydantic
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader  # type: ignore
+
+
+def load_yaml(stream: Any) -> Any:
+    """Load YAML safely, using the LibYAML-based loader if available."""
+    return yaml.load(stream, Loader=SafeLoader)
+
 
 def load_config_from_file(
     config_file: str, overrides: dict[str, Any]
@@ -19,7 +29,7 @@ def load_config_from_file(
 
 def process_single_file(config_file: str, conf: dict[str, Any]) -> None:
     with open(config_file, "r") as stream:
-        yml = yaml.safe_load(stream)
+        yml = load_yaml(stream)
     if yml is not None:
         if not isinstance(yml, dict):
             raise ValueError(f"The YAML file {config_file} is not a mapping")
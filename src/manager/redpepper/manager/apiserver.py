@@ -1,10 +1,12 @@
 import io
+import json
 import logging
 import os
 import pathlib
 import secrets
 import time
 import typing
+import zlib
 
 import argon2
 import hpack.hpack
@@ -22,6 +24,7 @@ from fastapi import (
     status,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from hypercorn.trio import serve
 from pydantic import BaseModel
@@ -91,15 +94,48 @@ class APIServer:
             "/api/v1/config/tree",
             self.get_config_tree,  # type: ignore
         )
+        self.app.add_api_route(
+            "/api/v1/data/publish",
+            self.publish_data,  # type: ignore
+            methods=["POST"],
+        )
+        self.app.add_api_route(
+            "/api/v1/compliance",
+            self.get_compliance,  # type: ignore
+        )
         self.app.add_api_route(
             "/api/v1/command",
             self.command,  # type: ignore
             methods=["POST"],
         )
+        self.app.add_api_route(
+            "/api/v1/commands",
+            self.get_commands,  # type: ignore
+        )
+        self.app.add_api_route(
+            "/api/v1/commands/search",
+            self.search_commands,  # type: ignore
+        )
+        self.app.add_api_route(
+            "/api/v1/commands/analytics",
+            self.get_command_analytics,  # type: ignore
+        )
+        self.app.add_api_route(
+            "/api/v1/commands/archive",
+            self.get_archived_commands,  # type: ignore
+        )
+        self.app.add_api_route(
+            "/api/v1/commands/export",
+            self.export_commands,  # type: ignore
+        )
         self.app.add_api_route(
             "/api/v1/commands/last",
             self.get_command_log_last,  # type: ignore
         )
+        self.app.add_api_route(
+            "/api/v1/commands/{command_id}/output",
+            self.get_command_output,  # type: ignore
+        )
         self.app.add_api_websocket_route(
             "/api/v1/events/ws",
             self.event_channel,
@@ -240,6 +276,12 @@ class APIServer:
         logger.debug("No TOTP secret found for user %s", username)
         return False
 
+    async def data_changed(self):
+        self.manager.data_manager.invalidate_data_file_index()
+        if self.manager.state_compiler is not None:
+            self.manager.state_compiler.invalidate()
+        await self.manager.publish_data()
+
     # API Endpoints
 
     async def event_channel(self, websocket: WebSocket):
@@ -247,11 +289,32 @@ class APIServer:
             self.check_session(websocket)  # type: ignore
         except HTTPException:
             raise WebSocketException(status.WS_1008_POLICY_VIOLATION)
-        consumer = self.manager.event_bus.add_consumer()
+        # The sequence number of the last event received, to resume after it
+        after_param = websocket.query_params.get("after")
+        try:
+            after = int(after_param) if after_param is not None else None
+        except ValueError:
+            raise WebSocketException(status.WS_1008_POLICY_VIOLATION)
+        # Repeated query parameters, e.g. ?type=command_progress&type=command_result
+        consumer = self.manager.event_bus.add_consumer(
+            types=websocket.query_params.getlist("type") or None,
+            agents=websocket.query_params.getlist("agent") or None,
+            commands=websocket.query_params.getlist("command") or None,
+            after=after,
+        )
         try:
             await websocket.accept()
-            async for event in consumer:
-                await websocket.send_json(event)
+            while True:
+                try:
+                    events = await consumer.get()
+                except trio.EndOfChannel:
+                    break
+                # One JSON array per frame, from events encoded once for all the consumers
+                await websocket.send_text(
+                    "[" + ",".join(event.json for event in events) + "]"
+                )
+                # Events arriving in the meantime are batched (and progress coalesced)
+                await trio.sleep(self.config.api_event_batch_interval)
         finally:
             self.manager.event_bus.remove_consumer(consumer)
 
@@ -279,6 +342,7 @@ class APIServer:
         if isdir:
             func = self.file_manager.create_new_conf_dir
         success, detail = await trio.to_thread.run_sync(func, path)
+        await self.data_changed()
         return {"success": success, "detail": detail}
 
     async def delete_config_file(self, request: Request, path: str):
@@ -286,13 +350,14 @@ class APIServer:
         success, detail = await trio.to_thread.run_sync(
             self.file_manager.delete_conf_file, path
         )
+        await self.data_changed()
         return {"success": success, "detail": detail}
 
     async def get_agents(self, request: Request):
         self.check_session(request)
         agents = []
         connected = self.manager.connected_agents()
-        for agent in self.manager.data_manager.get_agent_names():
+        for agent in await self.manager.async_data_manager.get_agent_names():
             agents.append(
                 {
                     "id": agent,
@@ -303,7 +368,16 @@ class APIServer:
 
     async def get_agent_names(self, request: Request):
         self.check_session(request)
-        return {"agents": self.manager.data_manager.get_agent_names()}
+        return {"agents": await self.manager.async_data_manager.get_agent_names()}
+
+    async def get_compliance(
+        self, request: Request, state: str = "", changed_only: bool = False
+    ):
+        self.check_session(request)
+        agents = await self.manager.get_compliance(state)
+        if changed_only:
+            agents = [agent for agent in agents if agent["changed"]]
+        return {"agents": agents}
 
     async def get_config_file(self, request: Request, path: str):
         self.check_session(request)
@@ -321,6 +395,133 @@ class APIServer:
         self.check_session(request)
         return {"agents": self.manager.connected_agents()}
 
+    async def get_commands(
+        self,
+        request: Request,
+        agent: str | None = None,
+        status: int | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        limit: int = 50,
+        cursor: str | None = None,
+    ):
+        self.check_session(request)
+        try:
+            commands, next_cursor = await self.manager.command_log.query(
+                agent, status, command, since, until, limit, cursor
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"commands": commands, "next_cursor": next_cursor}
+
+    async def search_commands(
+        self,
+        request: Request,
+        q: str,
+        agent: str | None = None,
+        status: int | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        limit: int = 50,
+        cursor: str | None = None,
+    ):
+        self.check_session(request)
+        try:
+            commands, next_cursor = await self.manager.command_log.query(
+                agent, status, command, since, until, limit, cursor, search=q
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"commands": commands, "next_cursor": next_cursor}
+
+    async def get_command_analytics(
+        self,
+        request: Request,
+        group_by: str = "command",
+        agent: str | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+    ):
+        self.check_session(request)
+        try:
+            groups = await self.manager.command_log.analytics(
+                group_by, agent, command, since, until
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"groups": groups}
+
+    async def get_archived_commands(
+        self,
+        request: Request,
+        agent: str | None = None,
+        status: int | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        limit: int = 50,
+        cursor: str | None = None,
+    ):
+        self.check_session(request)
+        if self.manager.command_archive is None:
+            raise HTTPException(status_code=404, detail="Command archive not enabled")
+        try:
+            commands, next_cursor = await trio.to_thread.run_sync(
+                self.manager.command_archive.query,
+                agent,
+                status,
+                command,
+                since,
+                until,
+                limit,
+                cursor,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"commands": commands, "next_cursor": next_cursor}
+
+    async def export_commands(
+        self,
+        request: Request,
+        agent: str | None = None,
+        status: int | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        compress: bool = False,
+    ):
+        self.check_session(request)
+        commands = self.manager.command_log.export(agent, status, command, since, until)
+
+        async def generate():
+            # gzip format, so that the export can be saved as is
+            compressor = zlib.compressobj(wbits=31) if compress else None
+            async for command_info in commands:
+                line = json.dumps(command_info).encode() + b"\n"
+                if compressor is None:
+                    yield line
+                elif chunk := compressor.compress(line):
+                    yield chunk
+            if compressor is not None:
+                yield compressor.flush()
+
+        filename = "commands.ndjson.gz" if compress else "commands.ndjson"
+        return StreamingResponse(
+            generate(),
+            media_type="application/gzip" if compress else "application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+
+    async def get_command_output(self, request: Request, command_id: str):
+        self.check_session(request)
+        output = await self.manager.command_log.get_output(command_id)
+        if output is None:
+            raise HTTPException(status_code=404, detail="No output for this command")
+        return {"output": output}
+
     async def get_command_log_last(self, request: Request, max: int = 20):
         self.check_session(request)
         return {
@@ -354,6 +555,13 @@ class APIServer:
         request.session["otp_verified"] = False
         return {"success": True}
 
+    async def publish_data(self, request: Request):
+        self.check_session(request)
+        if self.manager.data_store is None:
+            return {"success": False, "detail": "data snapshots are not enabled"}
+        await self.data_changed()
+        return {"success": True, "version": self.manager.data_store.current_version}
+
     async def rename_config_file(
         self, request: Request, path: str, new_path: "ConfigFileName"
     ):
@@ -361,6 +569,7 @@ class APIServer:
         success, detail = await trio.to_thread.run_sync(
             self.file_manager.rename_conf_file, path, new_path.path
         )
+        await self.data_changed()
         return {"success": success, "detail": detail}
 
     async def save_config_file(
@@ -370,6 +579,7 @@ class APIServer:
         success, detail = await trio.to_thread.run_sync(
             self.file_manager.save_conf_file, path, data.data
         )
+        await self.data_changed()
         return {"success": success, "detail": detail}
 
     async def verify_totp(self, request: Request, totp: "TOTPCredentials"):
@@ -0,0 +1,155 @@
+"""Archival of old commands from the command log to compressed segment files"""
+
+import gzip
+import json
+import logging
+import os
+import pathlib
+import threading
+import time as time_module
+from typing import Any
+
+from .eventlog import CommandLog, decode_cursor, encode_cursor
+
+logger = logging.getLogger(__name__)
+
+
+class CommandArchive:
+    """An archive of commands in gzip-compressed NDJSON segment files.
+
+    Commands are appended in batches to the current segment,
+    each batch as one gzip member, until the segment reaches segment_max_size bytes.
+    The index (index.json) records the time range, number of commands
+    and size of each segment, so queries only read the segments that may match
+    and never the part of a segment still being written.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory: pathlib.Path, segment_max_size: int = 16 << 20):
+        self.directory = pathlib.Path(directory)
+        self.segment_max_size = segment_max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        try:
+            with open(self.directory / self.INDEX_FILE) as f:
+                self._segments: list[dict[str, Any]] = json.load(f)
+        except FileNotFoundError:
+            self._segments = []
+
+    def _save_index(self) -> None:
+        tmp = self.directory / f"{self.INDEX_FILE}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._segments, f)
+        os.replace(tmp, self.directory / self.INDEX_FILE)
+
+    def append(self, commands: list[dict[str, Any]]) -> None:
+        """Append commands to the archive.
+        Called from the command log's writer thread before it deletes them."""
+        if not commands:
+            return
+        data = gzip.compress(
+            b"".join(
+                json.dumps(command, separators=(",", ":")).encode() + b"\n"
+                for command in commands
+            )
+        )
+        times = [command["time"] for command in commands]
+        with self._lock:
+            segment = self._segments[-1] if self._segments else None
+            if segment is None or segment["size"] >= self.segment_max_size:
+                segment = {
+                    "file": f"commands-{int(min(times))}-{len(self._segments)}.ndjson.gz",
+                    "first_time": min(times),
+                    "last_time": max(times),
+                    "count": 0,
+                    "size": 0,
+                }
+                self._segments.append(segment)
+            with open(self.directory / segment["file"], "ab") as f:
+                # Drop whatever a crash left after the last indexed batch
+                f.truncate(segment["size"])
+                f.write(data)
+            segment["first_time"] = min(segment["first_time"], *times)
+            segment["last_time"] = max(segment["last_time"], *times)
+            segment["count"] += len(commands)
+            segment["size"] += len(data)
+            self._save_index()
+
+    def purge(self, max_age: float) -> int:
+        """Delete the segments whose commands are all older than max_age seconds.
+        Returns the number of commands deleted."""
+        cutoff = time_module.time() - max_age
+        deleted = 0
+        with self._lock:
+            # The current segment is kept, as it is still being appended to
+            for segment in self._segments[:-1]:
+                if segment["last_time"] >= cutoff:
+                    continue
+                try:
+                    os.unlink(self.directory / segment["file"])
+                except FileNotFoundError:
+                    pass
+                deleted += segment["count"]
+            self._segments = [
+                segment
+                for segment in self._segments[:-1]
+                if segment["last_time"] >= cutoff
+            ] + self._segments[-1:]
+            self._save_index()
+        return deleted
+
+    def _read_segment(self, segment: dict[str, Any]) -> list[dict[str, Any]]:
+        try:
+            with open(self.directory / segment["file"], "rb") as f:
+                data = f.read(segment["size"])
+        except FileNotFoundError:
+            # Purged in the meantime
+            return []
+        return [json.loads(line) for line in gzip.decompress(data).splitlines()]
+
+    def query(
+        self,
+        agent: str | None = None,
+        status: int | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        limit: int = 50,
+        cursor: str | None = None,
+    ) -> tuple[list[dict[str, Any]], str | None]:
+        """Get the archived commands matching the filters, most recent first,
+        like CommandLog.query() with include_output."""
+        limit = max(1, min(limit, CommandLog.MAX_PAGE_SIZE))
+        position = decode_cursor(cursor) if cursor is not None else None
+        with self._lock:
+            segments = [dict(segment) for segment in self._segments]
+        segments.sort(key=lambda segment: segment["last_time"], reverse=True)
+        matches: list[dict[str, Any]] = []
+        for segment in segments:
+            if since is not None and segment["last_time"] < since:
+                continue
+            if until is not None and segment["first_time"] >= until:
+                continue
+            if position is not None and segment["first_time"] > position[0]:
+                continue
+            if len(matches) > limit and segment["last_time"] < matches[limit]["time"]:
+                # Later segments only have older commands than the ones found
+                break
+            for entry in self._read_segment(segment):
+                if (
+                    (agent is None or entry["agent"] == agent)
+                    and (status is None or entry["status"] == status)
+                    and (command is None or entry["command"].get("command") == command)
+                    and (since is None or entry["time"] >= since)
+                    and (until is None or entry["time"] < until)
+                    and (position is None or (entry["time"], entry["id"]) < position)
+                ):
+                    matches.append(entry)
+            matches.sort(key=lambda entry: (entry["time"], entry["id"]), reverse=True)
+            del matches[limit + 1 :]
+        next_cursor = None
+        if len(matches) > limit:
+            del matches[limit:]
+            next_cursor = encode_cursor(matches[-1]["time"], matches[-1]["id"])
+        return matches, next_cursor
@@ -0,0 +1,103 @@
+"""Asynchronous access to the Manager's data"""
+
+import functools
+import logging
+from typing import Any, Callable, Hashable
+
+import trio
+from ordered_set import OrderedSet
+
+from redpepper.common.slot import Slot
+
+from .compiler import StateCompiler
+from .data import DataManager
+
+logger = logging.getLogger(__name__)
+_CANCELLED = Exception("in-flight call was cancelled")
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls into a single call.
+
+    While a call for a key is in progress, any other caller with the same key
+    waits for that call to finish and receives its result (or exception).
+    """
+
+    def __init__(self):
+        self._in_flight: dict[Hashable, Slot[tuple[Any, BaseException | None]]] = {}
+
+    async def run_sync_in_thread(
+        self, key: Hashable, func: Callable[..., Any], *args: Any
+    ) -> Any:
+        """Run func(*args) in a worker thread, unless a call for key is already running."""
+        while (slot := self._in_flight.get(key)) is not None:
+            logger.debug("Joining in-flight call for %r", key)
+            value, error = await slot.get()
+            if error is _CANCELLED:
+                # The original caller was cancelled, so try again
+                continue
+            if error is not None:
+                raise error
+            return value
+        slot = self._in_flight[key] = Slot()
+        try:
+            value = await trio.to_thread.run_sync(functools.partial(func, *args))
+        except Exception as e:
+            await slot.set((None, e))
+            raise
+        else:
+            await slot.set((value, None))
+            return value
+        finally:
+            del self._in_flight[key]
+            if not slot.is_set():
+                await slot.set((None, _CANCELLED))
+
+
+class AsyncDataManager:
+    """An async facade for a DataManager.
+
+    All loading, merging and file system probing is done in worker threads
+    so that it does not block the event loop, and identical concurrent
+    requests are coalesced so that the work is only done once.
+    If a StateCompiler is given, state definitions are compiled in its process pool.
+    """
+
+    def __init__(
+        self, data_manager: DataManager, compiler: StateCompiler | None = None
+    ):
+        self.data_manager = data_manager
+        self.compiler = compiler
+        self._single_flight = SingleFlight()
+
+    async def _call(self, method: str, *args: Any) -> Any:
+        return await self._single_flight.run_sync_in_thread(
+            (method, *args), getattr(self.data_manager, method), *args
+        )
+
+    async def get_agent_names(self) -> list[str]:
+        return await self._call("get_agent_names")
+
+    async def get_agent_entry(self, agent_id: str) -> dict:
+        return await self._call("get_agent_entry", agent_id)
+
+    async def get_groups_for_agent(self, agent_id: str) -> OrderedSet[str]:
+        return await self._call("get_groups_for_agent", agent_id)
+
+    async def get_data_for_agent(self, agent_id: str, name: str) -> Any:
+        return await self._call("get_data_for_agent", agent_id, name)
+
+    async def get_data_file_path(self, agent_id: str, name: str) -> str:
+        return await self._call("get_data_file_path", agent_id, name)
+
+    async def get_state_definition_for_agent(
+        self, agent_id: str, state_id: str | None = None
+    ) -> list:
+        if self.compiler is not None:
+            return await self._single_flight.run_sync_in_thread(
+                ("compile", agent_id, state_id),
+                self.compiler.compile,
+                agent_id,
+                state_id,
+            )
+        return await self._call("get_state_definition_for_agent", agent_id, state_id)
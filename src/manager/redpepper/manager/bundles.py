@@ -0,0 +1,140 @@
+"""Precompiled per-agent state bundles"""
+
+import hashlib
+import logging
+import os
+import zlib
+from collections import OrderedDict
+
+import msgpack
+import trio
+
+from .asyncdata import AsyncDataManager
+from .compliance import fingerprint_state, get_installed_files, walk_state_tasks
+from .datafiles import DigestCache
+
+logger = logging.getLogger(__name__)
+
+# Operation modules larger than this are not sent to agents
+MAX_MODULE_SIZE = 32 * 1024
+
+
+class StateBundleCache:
+    """Builds and serves state bundles for agents.
+
+    A bundle packs an agent's compiled state definition and its fingerprint
+    together with the stat and digest of every data file it installs (and the
+    contents of the small ones) and the custom operation modules it uses, so that
+    the agent can run the state without any further requests. A bundle is identified by the SHA-256 digest
+    of its contents, so an agent can keep using its copy until the digest changes.
+    Recently built bundles are kept in memory for the agent they were built for
+    to fetch in chunks.
+    """
+
+    def __init__(
+        self, digest_cache: DigestCache, max_file_size: int, max_size: int = 64
+    ):
+        self.digest_cache = digest_cache
+        self.max_file_size = max_file_size
+        self.max_size = max_size
+        self._bundles: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+
+    async def build(
+        self,
+        data_manager: AsyncDataManager,
+        agent_id: str,
+        state_name: str | None = None,
+    ) -> tuple[str, bytes]:
+        """Build the agent's bundle for the state and return its digest and compressed contents."""
+        state = await data_manager.get_state_definition_for_agent(agent_id, state_name)
+        files: dict[str, dict] = {}
+        modules: dict[str, dict] = {}
+        for task in walk_state_tasks(state):
+            task_type = task.get("type")
+            if not isinstance(task_type, str) or "." not in task_type:
+                continue
+            module_name = task_type.split(".", 1)[0]
+            if module_name not in modules and module_name.isidentifier():
+                module = await trio.to_thread.run_sync(
+                    self._read_module, data_manager, module_name
+                )
+                if module is not None:
+                    modules[module_name] = module
+            source = task.get("source")
+            if (
+                task_type == "file.Installed"
+                and task.get("method", "hash") != "content"
+                and isinstance(source, str)
+                and source not in files
+            ):
+                file = await self._get_file(data_manager, agent_id, source)
+                if file is not None:
+                    files[source] = file
+        fingerprint = fingerprint_state(
+            state,
+            {
+                name: files[name]["hash"] if name in files else None
+                for name in get_installed_files(state)
+            },
+        )
+        packed = msgpack.packb(
+            {
+                "state": state,
+                "files": files,
+                "modules": modules,
+                "fingerprint": fingerprint,
+            }
+        )
+        digest = hashlib.sha256(packed).hexdigest()
+        key = (agent_id, digest)
+        if key in self._bundles:
+            self._bundles.move_to_end(key)
+        else:
+            logger.debug("Built state bundle %s for agent %s", digest, agent_id)
+            self._bundles[key] = await trio.to_thread.run_sync(zlib.compress, packed)
+            while len(self._bundles) > self.max_size:
+                self._bundles.popitem(last=False)
+        return digest, self._bundles[key]
+
+    def read(self, agent_id: str, digest: str, offset: int, length: int) -> bytes:
+        """Read part of a bundle recently built for the agent.
+        Raises KeyError if it is no longer cached."""
+        return self._bundles[(agent_id, digest)][offset : offset + length]
+
+    async def _get_file(
+        self, data_manager: AsyncDataManager, agent_id: str, name: str
+    ) -> dict | None:
+        try:
+            path = await data_manager.get_data_file_path(agent_id, name)
+            stat = os.stat(path)
+            file = {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "hash": await self.digest_cache.get_digest(path),
+                "content": None,
+            }
+            if stat.st_size <= self.max_file_size:
+                file["content"] = await trio.to_thread.run_sync(self._read_file, path)
+        except (ValueError, OSError):
+            # Leave it to the agent to request the file and get the error
+            return None
+        return file
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def _read_module(data_manager: AsyncDataManager, name: str) -> dict | None:
+        path = data_manager.data_manager.get_operation_module_path(name)
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                content = f.read(MAX_MODULE_SIZE + 1)
+        except FileNotFoundError:
+            return None
+        if len(content) > MAX_MODULE_SIZE:
+            # Leave it to the agent to request the module and get the error
+            return None
+        return {"mtime": stat.st_mtime, "size": len(content), "content": content}
@@ -0,0 +1,175 @@
+"""Compilation of state definitions in a pool of worker processes"""
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Iterable
+
+from .data import DataManager
+from .inventory import SQLiteInventory
+
+logger = logging.getLogger(__name__)
+
+
+def list_source_files(base_dir: pathlib.Path) -> list[tuple[str, int, int]]:
+    """List the YAML files that state compilation depends on.
+    Returns a sorted list of (relative path, mtime_ns, size) tuples.
+    """
+    files = []
+    for dirpath, recurse in (("", False), ("data", False), ("state", True)):
+        try:
+            entries = list(os.scandir(os.path.join(base_dir, dirpath)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            path = os.path.join(dirpath, entry.name) if dirpath else entry.name
+            if entry.is_file() and entry.name.endswith(".yml"):
+                stat = entry.stat()
+                files.append((path, stat.st_mtime_ns, stat.st_size))
+            elif recurse and entry.is_dir() and not entry.name.startswith("."):
+                for subentry in os.scandir(entry.path):
+                    if subentry.is_file() and subentry.name.endswith(".yml"):
+                        stat = subentry.stat()
+                        files.append(
+                            (
+                                os.path.join(path, subentry.name),
+                                stat.st_mtime_ns,
+                                stat.st_size,
+                            )
+                        )
+    files.sort()
+    return files
+
+
+class SnapshotDataManager(DataManager):
+    """A DataManager that serves YAML files from an in-memory snapshot."""
+
+    def __init__(
+        self,
+        base_dir: pathlib.Path,
+        files: dict[str, Any],
+        inventory_file: pathlib.Path | None = None,
+    ):
+        inventory = None
+        if inventory_file is not None:
+            inventory = SQLiteInventory(inventory_file)
+        super().__init__(base_dir, inventory=inventory)
+        self.files = files
+
+    def load_yaml_file(self, path: str) -> Any:
+        return self.files.get(path)
+
+
+_worker_data_manager: SnapshotDataManager | None = None
+
+
+def _init_worker(
+    base_dir: pathlib.Path,
+    files: dict[str, Any],
+    inventory_file: pathlib.Path | None,
+) -> None:
+    global _worker_data_manager
+    _worker_data_manager = SnapshotDataManager(base_dir, files, inventory_file)
+
+
+def _compile_in_worker(agent_id: str, state_id: str | None) -> list:
+    assert _worker_data_manager is not None
+    return _worker_data_manager.get_state_definition_for_agent(agent_id, state_id)
+
+
+class StateCompiler:
+    """Compiles state definitions for agents in a pool of worker processes.
+
+    The parsed source files are sent to each worker once when the pool is started.
+    When any source file changes, the pool is replaced with a new one.
+    The source files are checked for changes at most every check_interval seconds,
+    or on the next compilation after invalidate() is called.
+    """
+
+    def __init__(
+        self, data_manager: DataManager, workers: int, check_interval: float = 0
+    ):
+        self.data_manager = data_manager
+        self.workers = workers
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._pool: concurrent.futures.ProcessPoolExecutor | None = None
+        self._source_files: list[tuple[str, int, int]] | None = None
+        self._checked_at = -check_interval
+
+    def invalidate(self) -> None:
+        """Make the source files be checked for changes on the next compilation."""
+        self._checked_at = -self.check_interval
+
+    def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        now = time.monotonic()
+        pool = self._pool
+        if pool is not None and now - self._checked_at < self.check_interval:
+            return pool
+        source_files = list_source_files(self.data_manager.base_dir)
+        with self._lock:
+            self._checked_at = now
+            if self._pool is not None and source_files == self._source_files:
+                return self._pool
+            logger.info(
+                "Starting state compiler pool with %d workers for %d source files",
+                self.workers,
+                len(source_files),
+            )
+            files = {
+                path: self.data_manager.load_yaml_file(path)
+                for path, _, _ in source_files
+            }
+            inventory = self.data_manager.inventory
+            # Workers read an SQLite inventory directly, since it is not in the source files
+            inventory_file = None
+            if isinstance(inventory, SQLiteInventory):
+                inventory_file = inventory.filename
+            if self._pool is not None:
+                # Compilations already submitted to the old pool still finish
+                self._pool.shutdown(wait=False)
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_init_worker,
+                initargs=(self.data_manager.base_dir, files, inventory_file),
+            )
+            self._source_files = source_files
+            return self._pool
+
+    def compile(self, agent_id: str, state_id: str | None = None) -> list:
+        """Compile the state definition for the agent.
+        This blocks until the compilation is done, so call it from a worker thread.
+        """
+        return self._get_pool().submit(_compile_in_worker, agent_id, state_id).result()
+
+    def compile_many(
+        self, agent_ids: Iterable[str], state_id: str | None = None
+    ) -> dict[str, list | Exception]:
+        """Compile the state definition for each of the agents.
+        Returns a mapping of agent ID to the state definition or the exception raised.
+        """
+        pool = self._get_pool()
+        futures = {
+            agent_id: pool.submit(_compile_in_worker, agent_id, state_id)
+            for agent_id in agent_ids
+        }
+        results: dict[str, list | Exception] = {}
+        for agent_id, future in futures.items():
+            try:
+                results[agent_id] = future.result()
+            except Exception as e:
+                results[agent_id] = e
+        return results
+
+    def shutdown(self, cancel_futures: bool = True) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=cancel_futures)
+                self._pool = None
+                self._source_files = None
+                self._checked_at = -self.check_interval
@@ -0,0 +1,116 @@
+"""Fingerprints of agents' desired states and the states they last applied"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Any, Generator
+
+import msgpack
+import trio
+
+from .asyncdata import AsyncDataManager
+from .datafiles import DigestCache
+
+logger = logging.getLogger(__name__)
+
+
+def walk_state_tasks(items: Any) -> Generator[dict, None, None]:
+    """Yield the task definitions of a compiled state definition."""
+    if not isinstance(items, list):
+        return
+    for item in items:
+        if not isinstance(item, dict) or len(item) != 1:
+            continue
+        value = next(iter(item.values()))
+        if isinstance(value, list):
+            yield from walk_state_tasks(value)
+        elif isinstance(value, dict):
+            yield value
+
+
+def get_installed_files(state: list) -> list[str]:
+    """Get the names of the data files installed by a compiled state definition."""
+    files = []
+    for task in walk_state_tasks(state):
+        source = task.get("source")
+        if (
+            task.get("type") == "file.Installed"
+            and task.get("method", "hash") != "content"
+            and isinstance(source, str)
+            and source not in files
+        ):
+            files.append(source)
+    return files
+
+
+def fingerprint_state(state: list, file_digests: dict[str, str | None]) -> str:
+    """Get the fingerprint of a compiled state definition and the digests of the data files it installs."""
+    packed = msgpack.packb([state, sorted(file_digests.items())])
+    return hashlib.sha256(packed).hexdigest()
+
+
+async def get_state_fingerprint(
+    data_manager: AsyncDataManager,
+    digest_cache: DigestCache,
+    agent_id: str,
+    state: list,
+) -> str:
+    """Get the fingerprint of the agent's compiled state definition."""
+    file_digests: dict[str, str | None] = {}
+    for name in get_installed_files(state):
+        try:
+            path = await data_manager.get_data_file_path(agent_id, name)
+            file_digests[name] = await digest_cache.get_digest(path)
+        except (ValueError, OSError):
+            file_digests[name] = None
+    return fingerprint_state(state, file_digests)
+
+
+class AppliedStateLog:
+    """A persistent record of the fingerprint of the state each agent last applied successfully."""
+
+    INIT_SQL = """
+    CREATE TABLE IF NOT EXISTS redpepper_applied_states (
+        agent TEXT NOT NULL,
+        state TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        time REAL NOT NULL,
+        PRIMARY KEY (agent, state)
+    );
+    """
+
+    def __init__(self, filename=None):
+        self.db = sqlite3.connect(filename or ":memory:", check_same_thread=False)
+        self.db.executescript(self.INIT_SQL)
+        self.db.commit()
+        self._db_lock = threading.Lock()
+
+    async def state_applied(
+        self, agent: str, state: str, fingerprint: str, time: float
+    ) -> None:
+        await trio.to_thread.run_sync(
+            self._state_applied_sync, agent, state, fingerprint, time
+        )
+
+    def _state_applied_sync(
+        self, agent: str, state: str, fingerprint: str, time: float
+    ) -> None:
+        with self._db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO redpepper_applied_states (agent, state, fingerprint, time) VALUES (?, ?, ?, ?)",
+                (agent, state, fingerprint, time),
+            )
+            self.db.commit()
+
+    async def get_applied(self, state: str) -> dict[str, tuple[str, float]]:
+        """Get the fingerprint and time of the last successful apply of the state for each agent."""
+        return await trio.to_thread.run_sync(self._get_applied_sync, state)
+
+    def _get_applied_sync(self, state: str) -> dict[str, tuple[str, float]]:
+        with self._db_lock:
+            cursor = self.db.execute(
+                "SELECT agent, fingerprint, time FROM redpepper_applied_states WHERE state = ?",
+                (state,),
+            )
+            return {row[0]: (row[1], row[2]) for row in cursor}
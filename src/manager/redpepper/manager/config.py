@@ -1,6 +1,7 @@
 """RedPepper Manager configuration"""
 
 import pathlib
+from typing import Literal
 
 import pydantic
 
@@ -27,6 +28,8 @@ class APIConfig(pydantic.BaseModel):
     api_session_max_age: int = 43200
     api_static_dir: pydantic.DirectoryPath | None = None
     api_logins: list[APILogin] = []
+    api_event_replay_size: int = 1000
+    api_event_batch_interval: float = 0.1
 
     data_base_dir: pydantic.DirectoryPath
 
@@ -38,10 +41,34 @@ class ManagerConfig(BaseConfig, ConnectionConfig, TLSConfig, APIConfig):
 
     # Data
     data_base_dir: pydantic.DirectoryPath = pathlib.Path("/var/lib/redpepper/data")
+    data_cache_dir: pathlib.Path | None = pathlib.Path(
+        "/var/lib/redpepper-manager/data-cache"
+    )
+    data_file_index_interval: float = 10
+    agent_inventory: Literal["yaml", "sqlite"] = "yaml"
+    agent_inventory_file: pathlib.Path = pathlib.Path(
+        "/var/lib/redpepper-manager/agents.sqlite"
+    )
+    data_snapshots_dir: pathlib.Path | None = None
+    data_snapshots_keep: int = 10
+    state_compile_workers: int = 0
+    state_compile_check_interval: float = 10
+    data_file_digest_cache_file: pathlib.Path | None = pathlib.Path(
+        "/var/lib/redpepper-manager/digests.sqlite"
+    )
+    state_bundle_max_file_size: int = 65536
+    applied_states_file: pathlib.Path | None = pathlib.Path(
+        "/var/lib/redpepper-manager/applied-states.sqlite"
+    )
 
     # Command log
     command_log_max_age: int = 2592000
+    command_log_max_rows: int | None = None
+    command_log_max_size: int | None = None
     command_log_purge_interval: int = 86400
+    command_log_progress_interval: float = 5
     command_log_file: pathlib.Path = pathlib.Path(
         "/var/lib/redpepper-manager/commands.sqlite"
     )
+    command_archive_dir: pathlib.Path | None = None
+    command_archive_max_age: int = 31536000
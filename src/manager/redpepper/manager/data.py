@@ -1,15 +1,23 @@
 import functools
+import hashlib
 import importlib.util
 import logging
 import os
 import pathlib
 import re
+import threading
+import time
 from types import ModuleType
-from typing import Any
+from typing import Any, Sequence
 
+import msgpack
 import yaml
 from ordered_set import OrderedSet
 
+from redpepper.common.config import load_yaml
+
+from .inventory import Inventory, YAMLInventory
+
 logger = logging.getLogger(__name__)
 VALID_ID = re.compile(r"^[a-zA-Z0-9_-]+$")  # only alphanumeric, dash, and underscore
 
@@ -25,61 +33,261 @@ def is_valid_id(id):
     return isinstance(id, str) and bool(VALID_ID.match(id))
 
 
+_MISSING = object()
+
+
+class AgentDataView:
+    """A layered view of the data available to a single agent.
+
+    The layers are searched in order, so the agent's own data comes first,
+    followed by the data of each group in reverse order.
+    Dot-separated lookups are memoized, so a view should only be used
+    for as long as the underlying data is not expected to change,
+    e.g. for the duration of a single state evaluation.
+    """
+
+    def __init__(self, agent_id: str, groups: OrderedSet[str], layers: list[dict]):
+        self.agent_id = agent_id
+        self.groups = groups
+        self.layers = layers
+        self._lookups: dict[str, Any] = {}
+
+    def get(self, name: str) -> Any:
+        """Get the data for the dot-separated name, or raise KeyError if not found."""
+        if name == "<agent_id>":
+            return self.agent_id
+        elif name == "<groups>":
+            return list(self.groups)
+        value = self._lookups.get(name, _MISSING)
+        if value is _MISSING:
+            value = self._lookups[name] = self._lookup(name)
+        if value is _MISSING:
+            raise KeyError(f"data {name!r} not defined for {self.agent_id}")
+        return value
+
+    def _lookup(self, name: str) -> Any:
+        keys = name.split(".")
+        for layer in self.layers:
+            obj = layer
+            for key in keys:
+                if not isinstance(obj, dict):
+                    break
+                obj = obj.get(key, _MISSING)
+                if obj is _MISSING:
+                    break
+            else:
+                return obj
+        return _MISSING
+
+
+class DataFileIndex:
+    """An index of the files in the group directories of a data directory.
+
+    The index is rebuilt when it is older than max_age seconds,
+    so files added or removed by other means than the API may not be noticed until then.
+    Resolved file names are cached until the next rebuild. Names that were not found
+    are not, since any name can be requested.
+    """
+
+    def __init__(self, data_dir: str, max_age: float):
+        self.data_dir = data_dir
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._built_at = -max_age
+        self._files: dict[str, frozenset[str]] = {}
+        self._resolved: dict[tuple[tuple[str, ...], str], str] = {}
+
+    def invalidate(self) -> None:
+        """Make the index be rebuilt on its next use."""
+        self._built_at = -self.max_age
+
+    def resolve(self, groups: Sequence[str], name: str) -> str | None:
+        """Get the full path of the file name in the last of the groups that has it,
+        or None if none of them do. The name must be a sanitized relative path."""
+        if time.monotonic() - self._built_at >= self.max_age:
+            self._rebuild()
+        key = (tuple(groups), name)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        for group in reversed(groups):
+            if name in self._files.get(group, ()):
+                path = self._resolved[key] = os.path.join(self.data_dir, group, name)
+                return path
+        return None
+
+    def _rebuild(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._built_at < self.max_age:
+                # Rebuilt by another thread in the meantime
+                return
+            logger.debug("Indexing data files in %s", self.data_dir)
+            files = {}
+            try:
+                groups = os.listdir(self.data_dir)
+            except FileNotFoundError:
+                groups = []
+            for group in groups:
+                group_dir = os.path.join(self.data_dir, group)
+                if not is_valid_id(group) or not os.path.isdir(group_dir):
+                    continue
+                names = set()
+                # Directory path -> (device, inode) of it and its parent directories
+                ancestors: dict[str, frozenset[tuple[int, int]]] = {
+                    group_dir: frozenset([self._dir_id(group_dir)])
+                }
+                for dirpath, dirnames, filenames in os.walk(
+                    group_dir, followlinks=True
+                ):
+                    parents = ancestors.pop(dirpath)
+                    subdirs = []
+                    for dirname in dirnames:
+                        if dirname.startswith("."):
+                            continue
+                        subdir = os.path.join(dirpath, dirname)
+                        try:
+                            dir_id = self._dir_id(subdir)
+                        except OSError:
+                            continue
+                        if dir_id in parents:
+                            logger.warning("Not following symlink loop at %s", subdir)
+                            continue
+                        ancestors[subdir] = parents | {dir_id}
+                        subdirs.append(dirname)
+                    dirnames[:] = subdirs
+                    reldir = os.path.relpath(dirpath, group_dir)
+                    for filename in filenames:
+                        if filename.startswith(".") or "\\" in filename:
+                            continue
+                        path = os.path.join(dirpath, filename)
+                        if os.path.isfile(path):
+                            names.add(os.path.normpath(os.path.join(reldir, filename)))
+                files[group] = frozenset(names)
+            self._files = files
+            self._resolved = {}
+            self._built_at = now
+
+    @staticmethod
+    def _dir_id(path: str) -> tuple[int, int]:
+        stat = os.stat(path)
+        return (stat.st_dev, stat.st_ino)
+
+
 class DataManager:
-    def __init__(self, base_dir: pathlib.Path):
+    def __init__(
+        self,
+        base_dir: pathlib.Path,
+        cache_dir: pathlib.Path | None = None,
+        data_file_index_interval: float = 0,
+        inventory: Inventory | None = None,
+    ):
         self.base_dir = base_dir
+        self.inventory = inventory if inventory is not None else YAMLInventory(self)
+        self.cache_dir = cache_dir
         self._loaded_yaml_files = {}
-        self._loaded_request_modules = {}
+        self._loaded_request_modules: dict[str, tuple[ModuleType, int, int]] = {}
+        self._agent_groups: dict[str, tuple[Any, OrderedSet[str]]] = {}
+        self._data_file_index = None
+        self._request_module_index = None
+        if data_file_index_interval > 0:
+            self._data_file_index = DataFileIndex(
+                os.path.join(base_dir, "data"), data_file_index_interval
+            )
+            self._request_module_index = DataFileIndex(
+                os.path.join(base_dir, "requests"), data_file_index_interval
+            )
 
     def load_yaml_file(self, path: str) -> Any:
         """Load a YAML file from the base directory, or return None if not found or invalid."""
-        mtime, data = self._loaded_yaml_files.get(path, (None, None))
-        if mtime:
+        full_path = os.path.join(self.base_dir, path)
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            self._loaded_yaml_files.pop(path, None)
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._loaded_yaml_files.get(path)
+        if cached is not None and cached[0] == key:
+            logger.debug("Using cached data for %s", path)
+            return cached[1]
+        data = self._load_yaml_snapshot(full_path, key)
+        if data is _MISSING:
             try:
-                if mtime == os.path.getmtime(path):
-                    logger.debug("Using cached data for %s", path)
-                    return data
+                logger.debug("Loading data from %s", path)
+                with open(full_path, "rb") as f:
+                    try:
+                        data = load_yaml(f)
+                    except yaml.YAMLError:
+                        logger.warn("Failed to load YAML file: %r", path, exc_info=True)
+                        data = None
             except FileNotFoundError:
-                logger.warn("File not found: %s", path)
                 self._loaded_yaml_files.pop(path, None)
-                return {}
+                return None
+            self._save_yaml_snapshot(full_path, key, data)
+        self._loaded_yaml_files[path] = (key, data)
+        return data
+
+    def _get_yaml_snapshot_path(self, full_path: str) -> str | None:
+        if self.cache_dir is None:
+            return None
+        name = hashlib.sha256(os.path.abspath(full_path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + ".msgpack")
+
+    def _load_yaml_snapshot(self, full_path: str, key: tuple[int, int]) -> Any:
+        """Load the parsed data of a YAML file from the snapshot cache,
+        or return _MISSING if there is no snapshot for this version of the file."""
+        snapshot_path = self._get_yaml_snapshot_path(full_path)
+        if snapshot_path is None:
+            return _MISSING
         try:
-            logger.debug("Loading data from %s", path)
-            with open(os.path.join(self.base_dir, path)) as f:
-                try:
-                    data = yaml.safe_load(f)
-                except yaml.YAMLError:
-                    logger.warn("Failed to load YAML file: %r", path, exc_info=True)
-                    data = None
-                self._loaded_yaml_files[path] = (os.path.getmtime(path), data)
+            with open(snapshot_path, "rb") as f:
+                mtime_ns, size, data = msgpack.unpackb(f.read(), strict_map_key=False)
         except FileNotFoundError:
-            self._loaded_yaml_files.pop(path, None)
+            return _MISSING
+        except Exception:
+            logger.warning("Invalid YAML snapshot: %r", snapshot_path, exc_info=True)
+            return _MISSING
+        if (mtime_ns, size) != key:
+            return _MISSING
+        logger.debug("Using snapshot data for %s", full_path)
         return data
 
+    def _save_yaml_snapshot(self, full_path: str, key: tuple[int, int], data: Any):
+        """Save the parsed data of a YAML file to the snapshot cache."""
+        snapshot_path = self._get_yaml_snapshot_path(full_path)
+        if snapshot_path is None:
+            return
+        try:
+            packed = msgpack.packb([*key, data])
+        except (TypeError, ValueError, OverflowError):
+            # e.g. dates, which have no MessagePack representation
+            logger.debug("Not saving snapshot of %s: unsupported data", full_path)
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)  # type: ignore
+            tmp_path = f"{snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(packed)
+            os.replace(tmp_path, snapshot_path)
+        except OSError:
+            logger.warning(
+                "Failed to save YAML snapshot: %r", snapshot_path, exc_info=True
+            )
+
     # Agents and groups
 
     def get_agent_names(self):
-        """Get a list of agent IDs from agents.yml."""
-        agents_yml = self.load_yaml_file("agents.yml") or {}
-        if not isinstance(agents_yml, dict):
-            logger.warn("agents.yml is not a mapping")
-            return []
-        return list(agents_yml.keys())
+        """Get a list of agent IDs from the inventory."""
+        return self.inventory.get_agent_names()
 
     def get_agent_entry(self, agent_id: str) -> dict:
-        """Get the agent entry from agents.yml, or an empty dict if not found."""
+        """Get the agent entry from the inventory, or an empty dict if not found."""
         if not is_valid_id(agent_id):
             logger.warn("Invalid agent ID: %r", agent_id)
             return {}
-        agents_yml = self.load_yaml_file("agents.yml") or {}
-        if not isinstance(agents_yml, dict):
-            logger.warn("agents.yml is not a mapping")
-            return {}
-        entry: dict = agents_yml.get(agent_id, {})
-        if not isinstance(entry, dict):
-            logger.warn("Agent entry for %s is not a mapping", agent_id)
-            return {}
-        return entry
+        return self.inventory.get_agent_entry(agent_id)
 
     def get_groups_for_agent(self, agent_id: str) -> OrderedSet[str]:
         """Get the groups for the agent, based on groups.yml.
@@ -88,6 +296,10 @@ class DataManager:
         """
         groups: OrderedSet[str] = OrderedSet(())
         groups_yml: dict = self.load_yaml_file("groups.yml") or {}
+        # groups.yml is loaded as the same object for as long as it doesn't change
+        cached_yml, cached_groups = self._agent_groups.get(agent_id, (None, None))
+        if cached_yml is groups_yml and cached_groups is not None:
+            return cached_groups
         if not isinstance(groups_yml, dict):
             logger.warn("groups.yml is not a dict")
             return groups
@@ -106,6 +318,8 @@ class DataManager:
                     logger.warn("Invalid group ID: %r", group)
                     continue
                 groups.add(group)
+        if groups_yml:
+            self._agent_groups[agent_id] = (groups_yml, groups)
         return groups
 
     # Data
@@ -119,22 +333,25 @@ class DataManager:
         "<agent_id>" returns the agent ID.
         "<groups>" returns the list of groups to which the agent belongs.
         """
-        if name == "<agent_id>":
-            return agent_id
-        elif name == "<groups>":
-            return list(self.get_groups_for_agent(agent_id))
-        try:
-            return self.get_data_from_mapping(
-                self.get_agent_entry(agent_id).get("data", {}), name
-            )
-        except KeyError:
-            pass
-        for group_id in reversed(self.get_groups_for_agent(agent_id)):
-            try:
-                return self.get_data_for_group(group_id, name)
-            except KeyError:
-                pass
-        raise KeyError(f"data {name!r} not defined for {agent_id}")
+        return self.get_data_view_for_agent(agent_id).get(name)
+
+    def get_data_view_for_agent(
+        self, agent_id: str, groups: OrderedSet[str] | None = None
+    ) -> AgentDataView:
+        """Get a layered view of all the data available to the agent.
+        Use this instead of get_data_for_agent when looking up many names at once.
+        """
+        if groups is None:
+            groups = self.get_groups_for_agent(agent_id)
+        layers = []
+        agent_data = self.get_agent_entry(agent_id).get("data", {})
+        if isinstance(agent_data, dict):
+            layers.append(agent_data)
+        for group_id in reversed(groups):
+            group_data = self.load_yaml_file(f"data/{group_id}.yml") or {}
+            if isinstance(group_data, dict):
+                layers.append(group_data)
+        return AgentDataView(agent_id, groups, layers)
 
     def get_data_for_group(self, group: str, name: str):
         """Get the data for the group from the data directory, or raise KeyError if not found."""
@@ -164,6 +381,13 @@ class DataManager:
             parts.append(part)
         # Look for the requested file in the agent's groups
         groups = self.get_groups_for_agent(agent_id)
+        if self._data_file_index is not None:
+            if not parts:
+                raise FileNotFoundError(f"File not found: {name}")
+            path = self._data_file_index.resolve(groups, os.path.join(*parts))
+            if path is None:
+                raise FileNotFoundError(f"File not found: {name}")
+            return path
         for group in reversed(groups):
             path = os.path.join(self.base_dir, "data", group, *parts)
             if os.path.isfile(path):
@@ -171,6 +395,13 @@ class DataManager:
                 return path
         raise FileNotFoundError(f"File not found: {name}")
 
+    def invalidate_data_file_index(self) -> None:
+        """Make newly added or removed data files and request modules visible immediately."""
+        if self._data_file_index is not None:
+            self._data_file_index.invalidate()
+        if self._request_module_index is not None:
+            self._request_module_index.invalidate()
+
     # State definitions
 
     def get_state_definition_for_agent(
@@ -199,7 +430,9 @@ class DataManager:
                 continue
             self.merge_state(state, group_data)
         try:
-            state = self.interpolate_value_for_agent(agent_id, state)
+            state = self.interpolate_value(
+                self.get_data_view_for_agent(agent_id, groups), state
+            )
         except KeyError as e:
             raise ValueError(f"Interpolation failed for state definition: {e}")
         return state
@@ -214,6 +447,11 @@ class DataManager:
                     if isinstance(existing_item[item_name], list) and isinstance(
                         item[item_name], list
                     ):
+                        # Copy before merging so that the loaded source data
+                        # (which is cached) is never modified
+                        existing_item = state[i] = {
+                            item_name: list(existing_item[item_name])
+                        }
                         self.merge_state(existing_item[item_name], item[item_name])
                     else:
                         state[i] = item
@@ -226,26 +464,30 @@ class DataManager:
 
     def interpolate_value_for_agent(self, agent_id: str, value: Any) -> Any:
         """Interpolate the value using the data for the agent."""
+        return self.interpolate_value(self.get_data_view_for_agent(agent_id), value)
+
+    def interpolate_value(self, view: AgentDataView, value: Any) -> Any:
+        """Interpolate the value using the given data view."""
         if isinstance(value, dict):
             new = {}
             for k, v in value.items():
-                new[k] = self.interpolate_value_for_agent(agent_id, v)
+                new[k] = self.interpolate_value(view, v)
             return new
         elif isinstance(value, list):
             new = []
             for v in value:
-                new.append(self.interpolate_value_for_agent(agent_id, v))
+                new.append(self.interpolate_value(view, v))
             return new
         elif isinstance(value, str):
             # If the whole thing is an interpolation, return the result directly
             # so that structured data can be used as-is
             if self.FULL_INTERPOLATION_REGEX.match(value):
-                return self.get_data_for_agent(agent_id, value[2:-1])
+                return view.get(value[2:-1])
 
             def repl(m: re.Match):
                 if m.group(1) == "{":
                     return "${"
-                return str(self.get_data_for_agent(agent_id, m.group(3)))
+                return str(view.get(m.group(3)))
 
             return self.INTERPOLATION_REGEX.sub(repl, value)
         return value
@@ -261,46 +503,46 @@ class DataManager:
     # Custom request modules
 
     def get_request_module(self, agent_id: str, module_name: str) -> ModuleType:
+        """Get the custom request module for the agent from the last of its groups that has it.
+        Modules are loaded once per file and shared by all the agents that use them,
+        and are reloaded when the file changes."""
         if not module_name.isidentifier():
             raise ImportError(f"Invalid request module name: {module_name!r}")
-        key = (agent_id, module_name)
-        for group_id in reversed(self.get_groups_for_agent(agent_id)):
+        path = self.get_request_module_path(agent_id, module_name)
+        if path is None:
+            raise ImportError(f"Request module not found: {module_name!r}")
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError as e:
+            raise ImportError(f"Request module not found: {module_name!r}") from e
+        cached = self._loaded_request_modules.get(path)
+        if cached is not None and cached[1:] == (stat.st_mtime_ns, stat.st_size):
+            return cached[0]
+        logger.debug("Loading request module %s", path)
+        try:
+            spec = importlib.util.spec_from_file_location(
+                "redpepper.requests." + module_name, path
+            )
+            if spec is None or spec.loader is None:
+                raise ImportError(f"Error loading request module {module_name!r}")
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except Exception as e:
+            logger.error("Error loading request module: %r", path, exc_info=True)
+            self._loaded_request_modules.pop(path, None)
+            raise ImportError(f"Error loading request module {module_name!r}") from e
+        self._loaded_request_modules[path] = (module, stat.st_mtime_ns, stat.st_size)
+        return module
+
+    def get_request_module_path(self, agent_id: str, module_name: str) -> str | None:
+        """Get the path of the request module in the last of the agent's groups that has it, if any."""
+        groups = self.get_groups_for_agent(agent_id)
+        if self._request_module_index is not None:
+            return self._request_module_index.resolve(groups, module_name + ".py")
+        for group_id in reversed(groups):
             path = os.path.join(
                 self.base_dir, "requests", group_id, module_name + ".py"
             )
             if os.path.isfile(path):
-                break
-        else:
-            raise ImportError(f"Request module not found: {module_name!r}")
-        try:
-            module, cpath, cmtime, csize = self._loaded_request_modules[key]
-            if path != cpath:
-                raise KeyError
-            stat = os.stat(path)
-            mtime = stat.st_mtime
-            if mtime != cmtime:
-                raise KeyError
-            size = stat.st_size
-            if size != csize:
-                raise KeyError
-            return module
-        except KeyError:
-            stat = os.stat(path)
-            mtime = stat.st_mtime
-            size = stat.st_size
-            try:
-                spec = importlib.util.spec_from_file_location(
-                    "redpepper.requests." + module_name, path
-                )
-                if spec is None or spec.loader is None:
-                    raise ImportError(f"Error loading request module {module_name!r}")
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
-                self._loaded_request_modules[key] = (module, path, mtime, size)
-                return module
-            except Exception as e:
-                logger.error("Error loading request module: %r", path, exc_info=True)
-                self._loaded_request_modules.pop(key, None)
-                raise ImportError(
-                    f"Error loading request module {module_name!r}"
-                ) from e
+                return path
+        return None
@@ -0,0 +1,156 @@
+"""Serving of data files to agents"""
+
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import trio
+
+from .asyncdata import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class DigestCache:
+    """A persistent cache of SHA-256 digests of data files.
+
+    Digests are keyed by the file's device and inode numbers and are valid
+    for as long as the file's size and modification time don't change.
+    Digests are computed in worker threads and shared between all agents.
+    """
+
+    INIT_SQL = """
+    CREATE TABLE IF NOT EXISTS redpepper_file_digests (
+        device INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (device, inode)
+    );
+    """
+
+    def __init__(self, filename: pathlib.Path | None = None):
+        self.db = sqlite3.connect(filename or ":memory:", check_same_thread=False)
+        self.db.executescript(self.INIT_SQL)
+        self.db.commit()
+        self._db_lock = threading.Lock()
+        self._digests: dict[tuple[int, int], tuple[int, int, str]] = {}
+        self._single_flight = SingleFlight()
+
+    async def get_digest(self, path: str) -> str:
+        """Get the hex SHA-256 digest of the file's contents."""
+        stat = os.stat(path)
+        cached = self._digests.get((stat.st_dev, stat.st_ino))
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        return await self._single_flight.run_sync_in_thread(
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns),
+            self._get_digest_sync,
+            path,
+        )
+
+    def _get_digest_sync(self, path: str) -> str:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            with self._db_lock:
+                row = self.db.execute(
+                    "SELECT size, mtime_ns, digest FROM redpepper_file_digests"
+                    " WHERE device = ? AND inode = ?",
+                    (stat.st_dev, stat.st_ino),
+                ).fetchone()
+            if row is not None and tuple(row[:2]) == (stat.st_size, stat.st_mtime_ns):
+                digest = row[2]
+            else:
+                logger.debug("Computing digest of %s", path)
+                digest = hashlib.file_digest(f, "sha256").hexdigest()
+                if os.fstat(f.fileno()).st_mtime_ns != stat.st_mtime_ns:
+                    # The file was modified while hashing it, so don't cache the digest
+                    return digest
+                with self._db_lock:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO redpepper_file_digests"
+                        " (device, inode, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)",
+                        (
+                            stat.st_dev,
+                            stat.st_ino,
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                            digest,
+                        ),
+                    )
+                    self.db.commit()
+        self._digests[(stat.st_dev, stat.st_ino)] = (
+            stat.st_size,
+            stat.st_mtime_ns,
+            digest,
+        )
+        return digest
+
+
+class _OpenFile:
+    def __init__(self, fd: int, key: tuple[int, int, int, int]):
+        self.fd = fd
+        self.key = key
+        self.users = 0
+        self.evicted = False
+
+
+class FileHandleCache:
+    """An LRU cache of open data files for serving file contents to agents.
+
+    Cached files are validated against the file's current stat before each read,
+    so a replaced or modified file is reopened. Reads are done with os.pread
+    in worker threads, so one open file can serve many agents at once.
+    """
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self._files: OrderedDict[str, _OpenFile] = OrderedDict()
+
+    async def read(self, path: str, offset: int, length: int) -> bytes:
+        """Read up to length bytes from the file starting at offset."""
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        file = self._files.get(path)
+        if file is not None and file.key != key:
+            self._evict(path)
+            file = None
+        if file is None:
+            file = await trio.to_thread.run_sync(self._open, path)
+            if path in self._files:
+                # Opened by another task in the meantime
+                self._evict(path)
+            self._files[path] = file
+            while len(self._files) > self.max_size:
+                self._evict(next(iter(self._files)))
+        else:
+            self._files.move_to_end(path)
+        file.users += 1
+        try:
+            return await trio.to_thread.run_sync(os.pread, file.fd, length, offset)
+        finally:
+            file.users -= 1
+            if file.evicted and file.users == 0:
+                os.close(file.fd)
+
+    def _open(self, path: str) -> _OpenFile:
+        logger.debug("Opening data file %s", path)
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        stat = os.fstat(fd)
+        return _OpenFile(fd, (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+
+    def _evict(self, path: str) -> None:
+        file = self._files.pop(path)
+        file.evicted = True
+        if file.users == 0:
+            os.close(file.fd)
+
+    def close(self) -> None:
+        """Close all the cached files."""
+        while self._files:
+            self._evict(next(iter(self._files)))
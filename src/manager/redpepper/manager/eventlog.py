@@ -1,121 +1,1044 @@
+import base64
+import functools
+import itertools
 import json
 import logging
+import queue
+import re
 import sqlite3
+import threading
 import time as time_module
+import zlib
 from collections import deque
-from typing import Any
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Callable, Iterable
 
 import trio
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+if TYPE_CHECKING:
+    from .archive import CommandArchive  # pragma: no cover
+
 logger = logging.getLogger(__name__)
+_STOP = object()
+# The longest snippet of output returned by a search
+SNIPPET_LENGTH = 200
+
+
+def encode_event(data: dict[str, Any]) -> str:
+    """Encode an event as JSON, using orjson if available."""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, separators=(",", ":"))
+
+
+class Event:
+    """An event posted on the event bus.
+    It is encoded as JSON at most once, however many consumers send it."""
+
+    def __init__(self, data: dict[str, Any]):
+        self.data = data
+
+    @functools.cached_property
+    def json(self) -> str:
+        return encode_event(self.data)
+
+
+class EventConsumer:
+    """The queue of events for one consumer of the event bus.
+
+    A queued command_progress event is superseded by a newer one for the same
+    command, which takes its place at the end of the queue, so the queue stays
+    in seq order. Other events are never dropped, unless the consumer falls
+    max_pending events behind: the queued events are then replaced by a "gap" event,
+    so the consumer knows to fetch the current state again, followed by
+    the most recent command results, up to half of max_pending.
+    """
+
+    def __init__(self, max_pending: int, last_seq: int = 0):
+        self.max_pending = max_pending
+        # Queue key -> event, in queue order. Progress events are keyed by
+        # their command ID, so that a newer one replaces the queued one.
+        self._pending: dict[Any, Event] = {}
+        self._next_key = itertools.count()
+        # The sequence number of the last event taken, or the one to resume after
+        self._last_seq = last_seq
+        self._wakeup = trio.Event()
+        self._closed = False
+
+    def put(self, event: Event) -> None:
+        if self._closed:
+            return
+        if event.data.get("type") == "command_progress":
+            key = ("progress", event.data.get("id"))
+            self._pending.pop(key, None)
+        else:
+            if len(self._pending) >= self.max_pending:
+                self._drop_pending(event)
+            key = next(self._next_key)
+        self._pending[key] = event
+        self._wakeup.set()
+
+    def _drop_pending(self, event: Event) -> None:
+        logger.warning("Event bus consumer fell too far behind, dropping events")
+        # Consumers may be waiting for command results, so keep the recent ones
+        results = [
+            (key, pending)
+            for key, pending in self._pending.items()
+            if pending.data.get("type") == "command_result"
+        ]
+        results = results[max(0, len(results) - self.max_pending // 2) :]
+        gap = Event(
+            {
+                "type": "gap",
+                "after": self._last_seq,
+                "next": event.data.get("seq"),
+                "time": time_module.time(),
+            }
+        )
+        self._pending = {next(self._next_key): gap, **dict(results)}
+
+    def take(self) -> list[Event]:
+        """Take the queued events without waiting."""
+        events = list(self._pending.values())
+        self._pending = {}
+        self._last_seq = max(
+            [self._last_seq]
+            + [event.data["seq"] for event in events if "seq" in event.data]
+        )
+        return events
+
+    async def get(self) -> list[Event]:
+        """Wait for events and take all the queued ones.
+        Raises trio.EndOfChannel once the consumer is removed from the bus."""
+        while not self._pending:
+            if self._closed:
+                raise trio.EndOfChannel
+            await self._wakeup.wait()
+            self._wakeup = trio.Event()
+        return self.take()
+
+    def close(self) -> None:
+        self._closed = True
+        self._wakeup.set()
 
 
 class EventBus:
-    """An event bus that provides basic pub-sub functionality."""
+    """An event bus that provides basic pub-sub functionality.
+
+    Consumers may subscribe to only some event types, agents or commands.
+    The subscriptions are indexed by the values they accept,
+    so each event is only queued for the consumers that want it.
+
+    Every event is numbered with an increasing sequence number ("seq"),
+    and the last replay_size events are kept so that a consumer
+    can resume after the last event it received.
+    """
+
+    # Filter name -> event field it applies to
+    FILTER_FIELDS = {"types": "type", "agents": "agent", "commands": "id"}
+    # The number of recent events replayed to new consumers not resuming
+    RECENT_EVENTS = 10
+    # The number of events other than progress consumers can fall behind by
+    MAX_PENDING = 1000
 
-    def __init__(self):
-        self.consumers: dict[int, trio.MemorySendChannel[dict[str, Any]]] = {}
-        self.most_recent = deque(maxlen=10)
+    def __init__(self, replay_size: int = 1000):
+        self.consumers: dict[int, EventConsumer] = {}
+        self.most_recent: deque[Event] = deque(maxlen=max(replay_size, 1))
+        self.last_seq = 0
+        # Filter name -> accepted value -> consumers
+        self._index: dict[str, dict[Any, set[int]]] = {
+            name: {} for name in self.FILTER_FIELDS
+        }
+        # Filter name -> consumers accepting any value
+        self._unfiltered: dict[str, set[int]] = {
+            name: set() for name in self.FILTER_FIELDS
+        }
+        self._filters: dict[int, dict[str, set[Any] | None]] = {}
 
-    def add_consumer(self) -> trio.MemoryReceiveChannel[dict[str, Any]]:
-        send, recv = trio.open_memory_channel(10)
-        self.consumers[id(recv)] = send
-        for event in self.most_recent:
+    def add_consumer(
+        self,
+        types: Iterable[str] | None = None,
+        agents: Iterable[str] | None = None,
+        commands: Iterable[str] | None = None,
+        after: int | None = None,
+    ) -> EventConsumer:
+        """Add a consumer of the events matching all the given filters.
+        A filter that is None accepts any value.
+
+        If after is given, the consumer first gets the kept events following
+        that sequence number, preceded by a "gap" event if some of them are
+        no longer kept. Otherwise it gets the most recent events.
+        """
+        filters = {
+            "types": set(types) if types is not None else None,
+            "agents": set(agents) if agents is not None else None,
+            "commands": set(commands) if commands is not None else None,
+        }
+        replay: list[Event] = []
+        if after is None:
+            replay = list(self.most_recent)[-self.RECENT_EVENTS :]
+        else:
+            first_seq = (
+                self.most_recent[0].data["seq"]
+                if self.most_recent
+                else self.last_seq + 1
+            )
+            # A sequence number from the future means the Manager was restarted
+            if after < first_seq - 1 or after > self.last_seq:
+                replay.append(
+                    Event(
+                        {
+                            "type": "gap",
+                            "after": after,
+                            "next": first_seq,
+                            "time": time_module.time(),
+                        }
+                    )
+                )
+            replay.extend(
+                event for event in self.most_recent if event.data["seq"] > after
+            )
+        replay = [
+            event
+            for event in replay
+            if event.data["type"] == "gap" or self._matches(filters, event.data)
+        ]
+        if after is None:
+            last_seq = replay[0].data["seq"] - 1 if replay else self.last_seq
+        else:
+            last_seq = min(after, self.last_seq)
+        # Leave room for the replayed events on top of the usual limit
+        consumer = EventConsumer(len(replay) + self.MAX_PENDING, last_seq)
+        self.consumers[id(consumer)] = consumer
+        self._filters[id(consumer)] = filters
+        for name, values in filters.items():
+            if values is None:
+                self._unfiltered[name].add(id(consumer))
+                continue
+            for value in values:
+                self._index[name].setdefault(value, set()).add(id(consumer))
+        for event in replay:
+            consumer.put(event)
+        return consumer
+
+    def _matches(
+        self, filters: dict[str, set[Any] | None], data: dict[str, Any]
+    ) -> bool:
+        for name, field in self.FILTER_FIELDS.items():
+            values = filters[name]
+            if values is None:
+                continue
             try:
-                send.send_nowait(event)
-            except (trio.WouldBlock, trio.ClosedResourceError) as e:
-                logger.warning("Event bus consumer queue full or closed: %s", e)
-        return recv
+                if data.get(field) not in values:
+                    return False
+            except TypeError:
+                return False
+        return True
 
-    def remove_consumer(
-        self, consumer: trio.MemoryReceiveChannel[dict[str, Any]]
-    ) -> None:
+    def remove_consumer(self, consumer: EventConsumer) -> None:
         self.consumers.pop(id(consumer)).close()
+        for name, values in self._filters.pop(id(consumer)).items():
+            if values is None:
+                self._unfiltered[name].discard(id(consumer))
+                continue
+            for value in values:
+                subscribed = self._index[name][value]
+                subscribed.discard(id(consumer))
+                if not subscribed:
+                    del self._index[name][value]
+
+    def _select(self, event: dict[str, Any]) -> set[int]:
+        """Get the consumers whose filters match the event."""
+        selected: set[int] | None = None
+        for name, field in self.FILTER_FIELDS.items():
+            value = event.get(field)
+            try:
+                subscribed = self._index[name].get(value, ())
+            except TypeError:
+                # Unhashable, so no filter can accept it
+                subscribed = ()
+            matching = self._unfiltered[name].union(subscribed)
+            selected = matching if selected is None else selected & matching
+            if not selected:
+                break
+        return selected or set()
 
     async def post(self, **kw: Any) -> None:
+        self.last_seq += 1
+        kw["seq"] = self.last_seq
         kw["time"] = time_module.time()
-        self.most_recent.append(kw)
-        for q in self.consumers.values():
-            try:
-                q.send_nowait(kw)
-            except (trio.WouldBlock, trio.ClosedResourceError) as e:
-                logger.warning("Event bus consumer queue full or closed: %s", e)
+        event = Event(kw)
+        self.most_recent.append(event)
+        for consumer in self._select(kw):
+            self.consumers[consumer].put(event)
+
+
+def _move_outputs_out_of_row(db: sqlite3.Connection) -> None:
+    """Schema migration that moves command output to a table of compressed blobs."""
+    db.execute(
+        "CREATE TABLE redpepper_command_outputs (id TEXT PRIMARY KEY NOT NULL, output BLOB NOT NULL)"
+    )
+    rows = db.execute(
+        "SELECT id, output FROM redpepper_commands WHERE output IS NOT NULL AND output != ''"
+    ).fetchall()
+    db.executemany(
+        "INSERT INTO redpepper_command_outputs (id, output) VALUES (?, ?)",
+        [(ID, compress_output(output)) for ID, output in rows],
+    )
+    db.execute("UPDATE redpepper_commands SET output = NULL")
+
+
+def _index_outputs(db: sqlite3.Connection) -> None:
+    """Schema migration that adds a full-text index of command output.
+    The outputs get an integer primary key to serve as rowid in the index,
+    since other rowids may change when the database is vacuumed."""
+    db.execute(
+        "CREATE TABLE redpepper_command_outputs_new ("
+        " num INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, output BLOB NOT NULL)"
+    )
+    db.execute(
+        "INSERT INTO redpepper_command_outputs_new (id, output)"
+        " SELECT id, output FROM redpepper_command_outputs"
+    )
+    db.execute("DROP TABLE redpepper_command_outputs")
+    db.execute(
+        "ALTER TABLE redpepper_command_outputs_new RENAME TO redpepper_command_outputs"
+    )
+    # Contentless, as the outputs are already stored (compressed) in redpepper_command_outputs
+    db.execute(
+        "CREATE VIRTUAL TABLE redpepper_command_output_search USING fts5(output, content='')"
+    )
+    for num, output in db.execute(
+        "SELECT num, output FROM redpepper_command_outputs"
+    ).fetchall():
+        db.execute(
+            "INSERT INTO redpepper_command_output_search (rowid, output) VALUES (?, ?)",
+            (num, decompress_output(output)),
+        )
+
+
+def _set_output(db: sqlite3.Connection, ID: str, output: str) -> None:
+    """Store the output of a command and index it for search."""
+    row = db.execute(
+        "SELECT num, output FROM redpepper_command_outputs WHERE id = ?", (ID,)
+    ).fetchone()
+    if row is not None:
+        _delete_outputs(db, [row])
+    num = db.execute(
+        "INSERT INTO redpepper_command_outputs (id, output) VALUES (?, ?)",
+        (ID, compress_output(output)),
+    ).lastrowid
+    db.execute(
+        "INSERT INTO redpepper_command_output_search (rowid, output) VALUES (?, ?)",
+        (num, output),
+    )
+
+
+def _delete_outputs(db: sqlite3.Connection, rows: list[tuple[int, bytes]]) -> None:
+    """Delete outputs given as (num, compressed output) and their index entries.
+    Entries of a contentless index can only be deleted by giving the indexed text."""
+    db.executemany(
+        "INSERT INTO redpepper_command_output_search"
+        " (redpepper_command_output_search, rowid, output) VALUES ('delete', ?, ?)",
+        [(num, decompress_output(output)) for num, output in rows],
+    )
+    db.executemany(
+        "DELETE FROM redpepper_command_outputs WHERE num = ?",
+        [(num,) for num, _ in rows],
+    )
+
+
+def get_snippets(output: str, search: str, max_snippets: int = 3) -> list[str]:
+    """Get the lines of the output containing words of the search query."""
+    words = [
+        word.lower()
+        for word in re.findall(r"\w+", search)
+        if word not in ("AND", "OR", "NOT", "NEAR")
+    ]
+    snippets = []
+    for line in output.splitlines():
+        lower = line.lower()
+        if any(word in lower for word in words):
+            snippets.append(line[:SNIPPET_LENGTH])
+            if len(snippets) == max_snippets:
+                break
+    return snippets
+
+
+def compress_output(output: str) -> bytes:
+    return zlib.compress(output.encode("utf-8"))
+
+
+def decompress_output(data: bytes) -> str:
+    return zlib.decompress(data).decode("utf-8")
 
 
 class CommandLog:
-    """A persistent log of commands, ordered by their time."""
-
-    # Someday this class's methods can be made more efficient
-    # by shifting all database accesses to a background thread
-    # via trio.to_thread.run_sync().
-    # For Python <3.11 sqlite3 isn't thread-safe, so we can't do that.
-    # Python 3.11's sqlite3 module has thread-safety features.
-
-    INIT_SQL = """
-    CREATE TABLE IF NOT EXISTS redpepper_commands (
-        id TEXT PRIMARY KEY NOT NULL,
-        time REAL,
-        agent TEXT,
-        command TEXT,
-        status INTEGER,
-        changed BOOLEAN,
-        progress_current INTEGER,
-        progress_total INTEGER,
-        output TEXT
-    );
+    """A persistent log of commands, ordered by their time.
+
+    Writes are queued and done by a dedicated writer thread, which groups
+    the writes queued within batch_interval seconds into one transaction.
+    Queries are done in worker threads on a separate read connection,
+    so database access never blocks the event loop.
+
+    The progress of running commands is kept in memory, where queries read it from.
+    It is only written to the database every progress_interval seconds
+    and when the command finishes.
+
+    Command output is stored compressed in a separate table,
+    so listing commands doesn't read it; use get_output() to get it.
     """
 
-    def __init__(self, filename):
-        self.db = sqlite3.connect(filename)
-        self.db.executescript(self.INIT_SQL)
-        self.db.commit()
+    # Each migration upgrades the schema by one version (as recorded in PRAGMA user_version).
+    # Never change a migration once released; add a new one instead.
+    MIGRATIONS: list[str | Callable[[sqlite3.Connection], None]] = [
+        """
+        CREATE TABLE IF NOT EXISTS redpepper_commands (
+            id TEXT PRIMARY KEY NOT NULL,
+            time REAL,
+            agent TEXT,
+            command TEXT,
+            status INTEGER,
+            changed BOOLEAN,
+            progress_current INTEGER,
+            progress_total INTEGER,
+            output TEXT
+        );
+        """,
+        """
+        CREATE INDEX redpepper_commands_time ON redpepper_commands (time, id);
+        CREATE INDEX redpepper_commands_agent ON redpepper_commands (agent, time, id);
+        CREATE INDEX redpepper_commands_status ON redpepper_commands (status, time, id);
+        CREATE INDEX redpepper_commands_type ON redpepper_commands (
+            json_extract(command, '$.command'), time, id
+        );
+        """,
+        _move_outputs_out_of_row,
+        _index_outputs,
+        """
+        ALTER TABLE redpepper_commands ADD COLUMN finish_time REAL;
+        ALTER TABLE redpepper_commands ADD COLUMN duration REAL;
+        """,
+    ]
+
+    # The largest number of commands returned by one query
+    MAX_PAGE_SIZE = 1000
+    # The keys commands can be grouped by in analytics
+    ANALYTICS_KEYS = {
+        "command": "json_extract(command, '$.command')",
+        "state": "json_extract(command, '$.args[0]')",
+        "agent": "agent",
+        "day": "date(time, 'unixepoch')",
+    }
+    # The percentiles of command durations computed by analytics
+    PERCENTILES = (50, 95, 99)
+    # The number of commands read at a time when exporting
+    EXPORT_PAGE_SIZE = 100
+    # The number of commands deleted per transaction when purging
+    PURGE_BATCH_SIZE = 1000
+    # The number of free pages returned to the file system per transaction
+    VACUUM_BATCH_PAGES = 1000
+
+    def __init__(
+        self,
+        filename,
+        batch_interval: float = 0.005,
+        progress_interval: float = 5,
+        archive: "CommandArchive | None" = None,
+    ):
+        self.batch_interval = batch_interval
+        self.progress_interval = progress_interval
+        self.archive = archive
+        write_db = sqlite3.connect(filename, check_same_thread=False)
+        self._enable_incremental_vacuum(write_db)
+        write_db.execute("PRAGMA journal_mode = WAL")
+        write_db.execute("PRAGMA synchronous = NORMAL")
+        self._migrate(write_db)
+        self._read_db = sqlite3.connect(filename, check_same_thread=False)
+        self._read_lock = threading.Lock()
+        # Command ID -> (current, total, time of the update)
+        self._progress: dict[str, tuple[int, int, float]] = {}
+        self._unwritten_progress: dict[str, tuple[int, int]] = {}
+        self._progress_lock = threading.Lock()
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._closed = False
+        self._writer = threading.Thread(
+            target=self._write_loop,
+            args=(write_db,),
+            name="command-log-writer",
+            daemon=True,
+        )
+        self._writer.start()
+
+    def _enable_incremental_vacuum(self, db: sqlite3.Connection) -> None:
+        # 2 = INCREMENTAL. Existing databases must be vacuumed once for it to apply.
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if db.execute("PRAGMA page_count").fetchone()[0]:
+            logger.info("Vacuuming command log to enable incremental vacuum")
+            db.execute("VACUUM")
+
+    def _migrate(self, db: sqlite3.Connection) -> None:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        for version in range(version, len(self.MIGRATIONS)):
+            logger.info("Migrating command log to schema version %d", version + 1)
+            migration = self.MIGRATIONS[version]
+            if isinstance(migration, str):
+                db.executescript(
+                    f"BEGIN; {migration} PRAGMA user_version = {version + 1}; COMMIT;"
+                )
+                continue
+            db.execute("BEGIN")
+            try:
+                migration(db)
+                db.execute(f"PRAGMA user_version = {version + 1}")
+            except BaseException:
+                db.rollback()
+                raise
+            db.commit()
+
+    def _write_loop(self, db: sqlite3.Connection) -> None:
+        next_progress_write = time_module.monotonic() + self.progress_interval
+        while True:
+            try:
+                batch = [
+                    self._queue.get(
+                        timeout=max(0, next_progress_write - time_module.monotonic())
+                    )
+                ]
+            except queue.Empty:
+                batch = []
+            deadline = time_module.monotonic() + self.batch_interval
+            # Collect more writes until the batch interval is over,
+            # unless a flush or close is waiting for the batch
+            while (
+                batch
+                and not isinstance(batch[-1], threading.Event)
+                and batch[-1] is not _STOP
+            ):
+                timeout = deadline - time_module.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stopping = bool(batch) and batch[-1] is _STOP
+            waiters = [item for item in batch if isinstance(item, threading.Event)]
+            try:
+                if stopping or time_module.monotonic() >= next_progress_write:
+                    self._write_progress(db)
+                    next_progress_write = (
+                        time_module.monotonic() + self.progress_interval
+                    )
+                for item in batch:
+                    if not isinstance(item, threading.Event) and item is not _STOP:
+                        self._write_item(db, item)
+                db.commit()
+            except Exception:
+                # Keep the writer running whatever happens, as everything waits on it
+                logger.error("Failed to write to command log", exc_info=True)
+                try:
+                    db.rollback()
+                except sqlite3.Error:
+                    logger.error("Failed to roll back command log", exc_info=True)
+            for waiter in waiters:
+                waiter.set()
+            if stopping:
+                db.close()
+                return
+
+    def _write_item(self, db: sqlite3.Connection, item: Any) -> None:
+        """Do one queued write in the batch's transaction,
+        undoing whatever part of it was done if it fails."""
+        if not db.in_transaction:
+            db.execute("BEGIN")
+        db.execute("SAVEPOINT redpepper_write")
+        try:
+            if callable(item):
+                item(db)
+            else:
+                db.execute(*item)
+        except Exception:
+            logger.error("Failed to write to command log", exc_info=True)
+            db.execute("ROLLBACK TO redpepper_write")
+        db.execute("RELEASE redpepper_write")
+
+    def _write_progress(self, db: sqlite3.Connection) -> None:
+        with self._progress_lock:
+            progress = self._unwritten_progress
+            self._unwritten_progress = {}
+        if not progress:
+            return
+        try:
+            db.executemany(
+                "UPDATE redpepper_commands SET progress_current = ?, progress_total = ? WHERE id = ?",
+                [(current, total, ID) for ID, (current, total) in progress.items()],
+            )
+        except sqlite3.Error:
+            logger.error("Failed to write progress to command log", exc_info=True)
+
+    def _write(self, sql: str, params: tuple = ()) -> None:
+        if self._closed:
+            logger.debug("Command log is closed, not writing")
+            return
+        self._queue.put((sql, params))
+
+    def _write_with(self, func: Callable[[sqlite3.Connection], None]) -> None:
+        """Queue a function to be called with the write connection in the writer thread."""
+        if self._closed:
+            logger.debug("Command log is closed, not writing")
+            return
+        self._queue.put(func)
+
+    async def flush(self) -> None:
+        """Wait until all the writes queued so far are committed."""
+        if self._closed:
+            return
+        self._check_writer()
+        done = threading.Event()
+        self._queue.put(done)
+
+        def wait() -> None:
+            while not done.wait(0.5):
+                self._check_writer()
+
+        await trio.to_thread.run_sync(wait)
+
+    def _check_writer(self) -> None:
+        if not self._writer.is_alive():
+            raise RuntimeError("The command log writer thread has stopped")
+
+    async def _read(self, sql: str, params: tuple = ()) -> list[tuple]:
+        def read():
+            with self._read_lock:
+                return self._read_db.execute(sql, params).fetchall()
+
+        return await trio.to_thread.run_sync(read)
+
+    def close(self) -> None:
+        """Write the queued writes and close the database."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._read_db.close()
+        if not self._queue.empty():
+            raise RuntimeError(
+                "The command log writer thread stopped before writing everything"
+            )
 
     async def command_started(self, ID: str, time: float, agent: str, command: str):
-        self.db.execute(
-            "INSERT INTO redpepper_commands (id, time, agent, command, status, changed, progress_current, progress_total, output) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (ID, time, agent, command, 0, False, 0, 0, ""),
+        self._write(
+            "INSERT INTO redpepper_commands (id, time, agent, command, status, changed, progress_current, progress_total) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (ID, time, agent, command, 0, False, 0, 0),
         )
-        self.db.commit()
 
     async def command_progressed(
-        self, ID: str, progress_current: str, progress_total: str
+        self, ID: str, progress_current: int, progress_total: int
     ):
-        self.db.execute(
-            "UPDATE redpepper_commands SET progress_current = ?, progress_total = ? WHERE id = ?",
-            (progress_current, progress_total, ID),
-        )
-        self.db.commit()
+        with self._progress_lock:
+            self._progress[ID] = (progress_current, progress_total, time_module.time())
+            self._unwritten_progress[ID] = (progress_current, progress_total)
 
-    async def command_finished(self, ID: str, status: int, changed: bool, output: str):
-        self.db.execute(
-            "UPDATE redpepper_commands SET status = ?, changed = ?, output = ? WHERE id = ?",
-            (status, changed, output, ID),
-        )
-        self.db.commit()
+    async def command_finished(
+        self,
+        ID: str,
+        status: int,
+        changed: bool,
+        output: str,
+        finish_time: float | None = None,
+    ):
+        if finish_time is None:
+            finish_time = time_module.time()
+        with self._progress_lock:
+            self._unwritten_progress.pop(ID, None)
+            progress = self._progress.pop(ID, None)
+
+        def write(db: sqlite3.Connection) -> None:
+            cursor = db.execute(
+                "UPDATE redpepper_commands SET status = ?, changed = ?,"
+                " finish_time = ?, duration = ? - time WHERE id = ?",
+                (status, changed, finish_time, finish_time, ID),
+            )
+            if cursor.rowcount == 0:
+                # Unknown or already purged, and its output would never be purged
+                logger.warning("Result for unknown command %s not logged", ID)
+                return
+            if progress is not None:
+                db.execute(
+                    "UPDATE redpepper_commands SET progress_current = ?, progress_total = ? WHERE id = ?",
+                    (*progress[:2], ID),
+                )
+            # Compressed and indexed here in the writer thread rather than in the event loop
+            _set_output(db, ID, output)
 
-    async def purge(self, max_age: float):
-        self.db.execute(
-            "DELETE FROM redpepper_commands WHERE time < ?",
-            (time_module.time() - max_age,),
+        self._write_with(write)
+
+    def get_progress(self, ID: str) -> tuple[int, int] | None:
+        """Get the latest progress of a running command, if any has been reported."""
+        with self._progress_lock:
+            progress = self._progress.get(ID)
+        return progress[:2] if progress is not None else None
+
+    async def purge(
+        self,
+        max_age: float,
+        max_rows: int | None = None,
+        max_size: int | None = None,
+    ) -> int:
+        """Delete the commands older than max_age seconds,
+        then the oldest commands beyond max_rows or while the database
+        uses more than max_size bytes, and return the space freed to the file system.
+        Commands are deleted in batches, so that other writes are not held up.
+        Returns the number of commands deleted."""
+        cutoff = time_module.time() - max_age
+        with self._progress_lock:
+            # Forget commands that stopped reporting progress without finishing
+            for ID in [ID for ID, p in self._progress.items() if p[2] < cutoff]:
+                del self._progress[ID]
+        total = 0
+        while deleted := await self._delete_batch("time < ?", (cutoff,)):
+            total += deleted
+        if max_rows is not None:
+            rows = await self._read(
+                "SELECT time, id FROM redpepper_commands"
+                " ORDER BY time DESC, id DESC LIMIT 1 OFFSET ?",
+                (max_rows,),
+            )
+            if rows:
+                while deleted := await self._delete_batch(
+                    "(time, id) <= (?, ?)", rows[0]
+                ):
+                    total += deleted
+        if max_size is not None:
+            while await self.get_size() > max_size:
+                deleted = await self._delete_batch("1", ())
+                if not deleted:
+                    break
+                total += deleted
+        await self._vacuum()
+        return total
+
+    async def _delete_batch(self, condition: str, params: tuple) -> int:
+        """Delete up to PURGE_BATCH_SIZE of the oldest commands matching the condition
+        in one transaction, moving them to the archive if there is one.
+        Returns the number of commands deleted."""
+        deleted = []
+
+        def delete(db: sqlite3.Connection) -> None:
+            IDs = db.execute(
+                f"SELECT id FROM redpepper_commands WHERE {condition}"
+                " ORDER BY time, id LIMIT ?",
+                (*params, self.PURGE_BATCH_SIZE),
+            ).fetchall()
+            outputs = db.execute(
+                "SELECT num, output, id FROM redpepper_command_outputs WHERE id IN"
+                f" ({','.join('?' * len(IDs))})",
+                [ID for (ID,) in IDs],
+            ).fetchall()
+            if self.archive is not None:
+                try:
+                    self._archive(db, IDs, outputs)
+                except OSError:
+                    logger.error("Failed to archive commands", exc_info=True)
+                    return
+            _delete_outputs(db, [(num, output) for num, output, _ in outputs])
+            db.executemany("DELETE FROM redpepper_commands WHERE id = ?", IDs)
+            deleted.append(len(IDs))
+
+        self._write_with(delete)
+        await self.flush()
+        return deleted[0] if deleted else 0
+
+    def _archive(
+        self,
+        db: sqlite3.Connection,
+        IDs: list[tuple[str]],
+        outputs: list[tuple[int, bytes, str]],
+    ) -> None:
+        assert self.archive is not None
+        output_by_id = {ID: output for _, output, ID in outputs}
+        commands = []
+        for row in db.execute(
+            "SELECT id, time, agent, command, status, changed, progress_current,"
+            " progress_total, finish_time, duration FROM redpepper_commands"
+            f" WHERE id IN ({','.join('?' * len(IDs))}) ORDER BY time, id",
+            [ID for (ID,) in IDs],
+        ):
+            output = output_by_id.get(row[0])
+            commands.append(
+                {
+                    "id": row[0],
+                    "time": row[1],
+                    "agent": row[2],
+                    "command": json.loads(row[3]),
+                    "status": row[4],
+                    "changed": row[5],
+                    "progress_current": row[6],
+                    "progress_total": row[7],
+                    "finish_time": row[8],
+                    "duration": row[9],
+                    "output": decompress_output(output) if output is not None else "",
+                }
+            )
+        self.archive.append(commands)
+
+    async def _vacuum(self) -> None:
+        """Return the free pages of the database to the file system, in batches."""
+        free_pages = []
+
+        def vacuum(db: sqlite3.Connection) -> None:
+            # The pragma frees one page per step, so it must be run to completion
+            db.execute(
+                f"PRAGMA incremental_vacuum({self.VACUUM_BATCH_PAGES})"
+            ).fetchall()
+            free_pages.append(db.execute("PRAGMA freelist_count").fetchone()[0])
+
+        while True:
+            free_pages.clear()
+            self._write_with(vacuum)
+            await self.flush()
+            if not free_pages or not free_pages[0]:
+                return
+
+    async def get_size(self) -> int:
+        """Get the number of bytes used by the database, excluding free pages."""
+        [(size,)] = await self._read(
+            "SELECT (page_count - freelist_count) * page_size"
+            " FROM pragma_page_count(), pragma_freelist_count(), pragma_page_size()"
         )
-        self.db.commit()
+        return size
 
     async def last(self, max: int):
-        cursor = self.db.execute(
-            "SELECT id, time, agent, command, status, changed, progress_current, progress_total, output"
-            " FROM redpepper_commands ORDER BY time DESC LIMIT ?",
-            (max,),
+        commands, _ = await self.query(limit=max, include_output=True)
+        for command in commands:
+            yield command
+
+    async def query(
+        self,
+        agent: str | None = None,
+        status: int | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        limit: int = 50,
+        cursor: str | None = None,
+        include_output: bool = False,
+        search: str | None = None,
+    ) -> tuple[list[dict[str, Any]], str | None]:
+        """Get the commands matching the filters, most recent first.
+        Returns up to limit commands and a cursor for getting the next ones,
+        or None if there are no more. The commands' output is only included
+        if include_output is True; otherwise use get_output().
+
+        If search is given, only the commands whose output matches
+        the full-text query are returned, with the matching lines as snippets.
+        """
+        limit = max(1, min(limit, self.MAX_PAGE_SIZE))
+        conditions = []
+        params: list[Any] = []
+        if search is not None:
+            conditions.append(
+                "o.num IN (SELECT rowid FROM redpepper_command_output_search"
+                " WHERE redpepper_command_output_search MATCH ?)"
+            )
+            params.append(search)
+        if agent is not None:
+            conditions.append("c.agent = ?")
+            params.append(agent)
+        if status is not None:
+            conditions.append("c.status = ?")
+            params.append(status)
+        if command is not None:
+            conditions.append("json_extract(c.command, '$.command') = ?")
+            params.append(command)
+        if since is not None:
+            conditions.append("c.time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("c.time < ?")
+            params.append(until)
+        if cursor is not None:
+            conditions.append("(c.time, c.id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        columns = (
+            "c.id, c.time, c.agent, c.command, c.status, c.changed,"
+            " c.progress_current, c.progress_total, c.finish_time, c.duration"
         )
-        for row in cursor:
-            yield {
+        join = ""
+        if include_output or search is not None:
+            columns += ", o.output"
+            join = " LEFT JOIN redpepper_command_outputs o ON o.id = c.id"
+        # Make the commands logged so far visible
+        await self.flush()
+        try:
+            rows = await self._read(
+                f"SELECT {columns} FROM redpepper_commands c{join}{where}"
+                " ORDER BY c.time DESC, c.id DESC LIMIT ?",
+                (*params, limit),
+            )
+        except sqlite3.OperationalError as e:
+            if search is None:
+                raise
+            raise ValueError(f"Invalid search query: {search!r}") from e
+        outputs: list[str] = []
+        if include_output or search is not None:
+            outputs = await trio.to_thread.run_sync(
+                lambda: [
+                    decompress_output(row[10]) if row[10] is not None else ""
+                    for row in rows
+                ]
+            )
+        commands = []
+        for i, row in enumerate(rows):
+            progress = self.get_progress(row[0]) or row[6:8]
+            command_info = {
                 "id": row[0],
                 "time": row[1],
                 "agent": row[2],
                 "command": json.loads(row[3]),
                 "status": row[4],
                 "changed": row[5],
-                "progress_current": row[6],
-                "progress_total": row[7],
-                "output": row[8],
+                "progress_current": progress[0],
+                "progress_total": progress[1],
+                "finish_time": row[8],
+                "duration": row[9],
+            }
+            if include_output:
+                command_info["output"] = outputs[i]
+            if search is not None:
+                command_info["snippets"] = get_snippets(outputs[i], search)
+            commands.append(command_info)
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+        return commands, next_cursor
+
+    async def export(
+        self,
+        agent: str | None = None,
+        status: int | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """Yield all the commands matching the filters with their output, most recent first.
+        Commands are read EXPORT_PAGE_SIZE at a time, so memory use is bounded
+        and the database is not kept locked while the consumer is slow."""
+        cursor = None
+        while True:
+            commands, cursor = await self.query(
+                agent,
+                status,
+                command,
+                since,
+                until,
+                self.EXPORT_PAGE_SIZE,
+                cursor,
+                include_output=True,
+            )
+            for command_info in commands:
+                yield command_info
+            if cursor is None:
+                return
+
+    async def analytics(
+        self,
+        group_by: str = "command",
+        agent: str | None = None,
+        command: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+    ) -> list[dict[str, Any]]:
+        """Get statistics of the finished commands started in the time range,
+        grouped by command, state, agent or day (in UTC): the number of commands,
+        their success rate and the average and percentiles of their durations.
+        Grouping by state only includes state commands."""
+        if group_by not in self.ANALYTICS_KEYS:
+            raise ValueError(f"Invalid group: {group_by!r}")
+        conditions = ["status != 0"]
+        params: list[Any] = []
+        if group_by == "state":
+            command = "state"
+        if agent is not None:
+            conditions.append("agent = ?")
+            params.append(agent)
+        if command is not None:
+            conditions.append("json_extract(command, '$.command') = ?")
+            params.append(command)
+        if since is not None:
+            conditions.append("time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            params.append(until)
+        # Nearest-rank percentiles: the ceil(p * n)th of the n durations of the group
+        percentiles = "".join(
+            f", MAX(CASE WHEN n = CAST({p / 100} * durations AS INTEGER)"
+            f" + ({p / 100} * durations > CAST({p / 100} * durations AS INTEGER))"
+            " THEN duration END)"
+            for p in self.PERCENTILES
+        )
+        await self.flush()
+        rows = await self._read(
+            f"""
+            WITH finished AS (
+                SELECT {self.ANALYTICS_KEYS[group_by]} AS key, status, duration
+                FROM redpepper_commands WHERE {" AND ".join(conditions)}
+            ), ranked AS (
+                SELECT key, status, duration,
+                    ROW_NUMBER() OVER (PARTITION BY key ORDER BY duration NULLS LAST) AS n,
+                    COUNT(duration) OVER (PARTITION BY key) AS durations
+                FROM finished
+            )
+            SELECT key, COUNT(*), SUM(status = 1), AVG(duration){percentiles}
+            FROM ranked GROUP BY key ORDER BY key
+            """,
+            tuple(params),
+        )
+        groups = []
+        for key, count, succeeded, average, *values in rows:
+            group = {
+                "key": key,
+                "count": count,
+                "succeeded": succeeded,
+                "success_rate": succeeded / count,
+                "duration_avg": average,
             }
-            await trio.sleep(0)
+            for p, value in zip(self.PERCENTILES, values):
+                group[f"duration_p{p}"] = value
+            groups.append(group)
+        return groups
+
+    async def get_output(self, ID: str) -> str | None:
+        """Get the output of a finished command, or None if it has none."""
+        await self.flush()
+        rows = await self._read(
+            "SELECT output FROM redpepper_command_outputs WHERE id = ?", (ID,)
+        )
+        if not rows:
+            return None
+        return await trio.to_thread.run_sync(decompress_output, rows[0][0])
+
+
+def encode_cursor(time: float, ID: str) -> str:
+    """Encode the position of a command in the log as an opaque string."""
+    return base64.urlsafe_b64encode(json.dumps([time, ID]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    try:
+        time, ID = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    if not isinstance(time, (int, float)) or not isinstance(ID, str):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return time, ID
@@ -0,0 +1,122 @@
+"""Backends for the inventory of agents known to the Manager"""
+
+import abc
+import json
+import logging
+import pathlib
+import sqlite3
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .data import DataManager  # pragma: no cover
+
+logger = logging.getLogger(__name__)
+
+
+class Inventory(abc.ABC):
+    """Base class for agent inventories.
+
+    An inventory maps each agent ID to the agent's entry,
+    which holds its secret hash, allowed IPs and agent-specific data.
+    """
+
+    @abc.abstractmethod
+    def get_agent_names(self) -> list[str]:
+        """Get the IDs of all the agents in the inventory."""
+
+    @abc.abstractmethod
+    def get_agent_entry(self, agent_id: str) -> dict:
+        """Get the agent's entry, or an empty dict if not found."""
+
+    def get_entries(self) -> dict[str, dict]:
+        """Get the entries of all the agents in the inventory."""
+        return {
+            agent_id: self.get_agent_entry(agent_id)
+            for agent_id in self.get_agent_names()
+        }
+
+
+class YAMLInventory(Inventory):
+    """An inventory stored in agents.yml in the data directory."""
+
+    def __init__(self, data_manager: "DataManager"):
+        self.data_manager = data_manager
+
+    def _load(self) -> dict:
+        agents_yml = self.data_manager.load_yaml_file("agents.yml") or {}
+        if not isinstance(agents_yml, dict):
+            logger.warn("agents.yml is not a mapping")
+            return {}
+        return agents_yml
+
+    def get_agent_names(self) -> list[str]:
+        return list(self._load().keys())
+
+    def get_agent_entry(self, agent_id: str) -> dict:
+        entry = self._load().get(agent_id, {})
+        if not isinstance(entry, dict):
+            logger.warn("Agent entry for %s is not a mapping", agent_id)
+            return {}
+        return entry
+
+
+class SQLiteInventory(Inventory):
+    """An inventory stored in an SQLite database indexed by agent ID,
+    so that looking up one agent doesn't require loading all of them."""
+
+    INIT_SQL = """
+    CREATE TABLE IF NOT EXISTS redpepper_agents (
+        id TEXT PRIMARY KEY NOT NULL,
+        entry TEXT NOT NULL
+    );
+    """
+
+    def __init__(self, filename: pathlib.Path):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(self.INIT_SQL)
+        self.db.commit()
+        self._db_lock = threading.Lock()
+
+    def get_agent_names(self) -> list[str]:
+        with self._db_lock:
+            rows = self.db.execute(
+                "SELECT id FROM redpepper_agents ORDER BY rowid"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_agent_entry(self, agent_id: str) -> dict:
+        with self._db_lock:
+            row = self.db.execute(
+                "SELECT entry FROM redpepper_agents WHERE id = ?", (agent_id,)
+            ).fetchone()
+        if row is None:
+            return {}
+        return json.loads(row[0])
+
+    def get_entries(self) -> dict[str, dict]:
+        with self._db_lock:
+            rows = self.db.execute(
+                "SELECT id, entry FROM redpepper_agents ORDER BY rowid"
+            ).fetchall()
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def set_entries(self, entries: dict[str, dict], replace: bool = False) -> None:
+        """Add or update the entries of the agents.
+        If replace is True, agents not in entries are removed."""
+        rows = [(agent_id, json.dumps(entry)) for agent_id, entry in entries.items()]
+        with self._db_lock, self.db:
+            if replace:
+                self.db.execute("DELETE FROM redpepper_agents")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO redpepper_agents (id, entry) VALUES (?, ?)",
+                rows,
+            )
+
+    def remove_agent(self, agent_id: str) -> None:
+        with self._db_lock, self.db:
+            self.db.execute("DELETE FROM redpepper_agents WHERE id = ?", (agent_id,))
+
+    def close(self) -> None:
+        self.db.close()
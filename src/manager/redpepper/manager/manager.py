@@ -5,10 +5,13 @@ import importlib
 import ipaddress
 import json
 import logging
+import math
 import ssl
 import time
 import uuid
+from collections import OrderedDict
 from enum import IntEnum
+from types import ModuleType
 from typing import Any, Callable, Coroutine, Iterable
 
 import trio
@@ -29,9 +32,17 @@ from redpepper.common.slot import Slot
 from redpepper.version import __version__
 
 from .apiserver import APIServer
+from .archive import CommandArchive
+from .asyncdata import AsyncDataManager
+from .bundles import StateBundleCache
+from .compiler import StateCompiler
+from .compliance import AppliedStateLog, get_state_fingerprint
 from .config import ManagerConfig
 from .data import DataManager
+from .datafiles import DigestCache, FileHandleCache
 from .eventlog import CommandLog, EventBus
+from .inventory import SQLiteInventory
+from .snapshots import DataStore
 
 logger = logging.getLogger(__name__)
 TRACE = 5
@@ -54,12 +65,57 @@ class Manager:
     running: trio.Event
     """Event that is set when the manager is running"""
 
+    MAX_NON_BUILTIN_REQUESTS = 1024
+    """The number of most recently used request names that are not builtin to remember"""
+
     def __init__(self, config: ManagerConfig):
         self.config = config
         self.connections: list[AgentConnection] = []
-        self.data_manager = DataManager(self.config.data_base_dir)
-        self.event_bus = EventBus()
-        self.command_log = CommandLog(self.config.command_log_file)
+        self.inventory = None
+        if self.config.agent_inventory == "sqlite":
+            self.inventory = SQLiteInventory(self.config.agent_inventory_file)
+        self.data_manager = DataManager(
+            self.config.data_base_dir,
+            self.config.data_cache_dir,
+            self.config.data_file_index_interval,
+            self.inventory,
+        )
+        self.state_compiler = None
+        if self.config.state_compile_workers > 0:
+            self.state_compiler = StateCompiler(
+                self.data_manager,
+                self.config.state_compile_workers,
+                self.config.state_compile_check_interval,
+            )
+        self.async_data_manager = AsyncDataManager(
+            self.data_manager, self.state_compiler
+        )
+        self.data_store = None
+        if self.config.data_snapshots_dir is not None:
+            self.data_store = DataStore(
+                self.config.data_snapshots_dir,
+                self.config.data_base_dir,
+                self.config.data_snapshots_keep,
+            )
+        self._versioned_data_managers: dict[str, AsyncDataManager] = {}
+        # The state compiler of the current published version, if any
+        self._versioned_compiler: tuple[str, StateCompiler] | None = None
+        self._publish_lock = trio.Lock()
+        self.digest_cache = DigestCache(self.config.data_file_digest_cache_file)
+        self.file_handle_cache = FileHandleCache()
+        self.state_bundles = StateBundleCache(
+            self.digest_cache, self.config.state_bundle_max_file_size
+        )
+        self.event_bus = EventBus(self.config.api_event_replay_size)
+        self.command_archive = None
+        if self.config.command_archive_dir is not None:
+            self.command_archive = CommandArchive(self.config.command_archive_dir)
+        self.command_log = CommandLog(
+            self.config.command_log_file,
+            progress_interval=self.config.command_log_progress_interval,
+            archive=self.command_archive,
+        )
+        self.applied_states = AppliedStateLog(self.config.applied_states_file)
         self.api_server = APIServer(self, self.config)
         self.running = trio.Event()
 
@@ -67,10 +123,12 @@ class Manager:
         self._last_command_id: int = 0
         self._cancel_scope = trio.CancelScope()
         self._command_result_handlers: dict[str, list[Callable]] = {}
+        self._non_builtin_requests: OrderedDict[str, None] = OrderedDict()
 
     async def run(self) -> None:
         """Run the manager"""
         with self._cancel_scope:
+            await self.publish_data()
             async with trio.open_nursery() as nursery:
                 nursery.start_soon(self.api_server.run)
                 nursery.start_soon(self._purge_command_log)
@@ -153,12 +211,129 @@ class Manager:
         finally:
             handlers.remove(slot.set)
 
+    def get_builtin_request_module(self, name: str) -> ModuleType | None:
+        """Get the builtin request module with the name, or None if there is none.
+        The most recently used names that are not builtin are remembered
+        so that custom requests don't search for a builtin module every time."""
+        if not name.isidentifier():
+            return None
+        if name in self._non_builtin_requests:
+            self._non_builtin_requests.move_to_end(name)
+            return None
+        module_name = f"redpepper.requests.{name}"
+        try:
+            return importlib.import_module(module_name)
+        except ImportError as e:
+            if isinstance(e, ModuleNotFoundError) and e.name == module_name:
+                self._non_builtin_requests[name] = None
+                if len(self._non_builtin_requests) > self.MAX_NON_BUILTIN_REQUESTS:
+                    self._non_builtin_requests.popitem(last=False)
+            return None
+
+    def get_async_data_manager(self, version: str | None) -> AsyncDataManager:
+        """Get the data manager for a version of the data published to the data store,
+        or the data manager for the live data directory if version is None."""
+        if version is None or self.data_store is None:
+            return self.async_data_manager
+        try:
+            return self._versioned_data_managers[version]
+        except KeyError:
+            pass
+        # Published versions never change, so their file index never needs rebuilding
+        data_manager = DataManager(
+            self.data_store.get_version_dir(version), None, math.inf, self.inventory
+        )
+        compiler = None
+        if (
+            self.config.state_compile_workers > 0
+            and version == self.data_store.current_version
+        ):
+            # Only the current version gets a worker pool, as it is the one
+            # agents are pinned to when they connect. Its files never change.
+            if self._versioned_compiler is not None:
+                self._retire_versioned_compiler()
+            compiler = StateCompiler(
+                data_manager, self.config.state_compile_workers, math.inf
+            )
+            self._versioned_compiler = (version, compiler)
+        async_data_manager = self._versioned_data_managers[version] = AsyncDataManager(
+            data_manager, compiler
+        )
+        return async_data_manager
+
+    def _retire_versioned_compiler(self) -> None:
+        """Compile the states of the version whose compiler is retired in the manager process,
+        letting the compilations already submitted finish."""
+        assert self._versioned_compiler is not None
+        version, compiler = self._versioned_compiler
+        self._versioned_compiler = None
+        async_data_manager = self._versioned_data_managers.get(version)
+        if async_data_manager is not None:
+            async_data_manager.compiler = None
+        compiler.shutdown(cancel_futures=False)
+
+    async def get_compliance(self, state_name: str = "") -> list[dict[str, Any]]:
+        """Compare each agent's current desired state with the one it last applied successfully."""
+        data_manager = self.get_async_data_manager(
+            self.data_store.current_version if self.data_store else None
+        )
+        applied = await self.applied_states.get_applied(state_name)
+        agents = []
+        for agent_id in await data_manager.get_agent_names():
+            entry: dict[str, Any] = {"agent": agent_id}
+            applied_fingerprint, applied_time = applied.get(agent_id, (None, None))
+            entry["applied_fingerprint"] = applied_fingerprint
+            entry["applied_time"] = applied_time
+            try:
+                state = await data_manager.get_state_definition_for_agent(
+                    agent_id, state_name or None
+                )
+                entry["fingerprint"] = await get_state_fingerprint(
+                    data_manager, self.digest_cache, agent_id, state
+                )
+            except ValueError as e:
+                entry["fingerprint"] = None
+                entry["error"] = str(e)
+            entry["changed"] = entry["fingerprint"] != applied_fingerprint
+            agents.append(entry)
+        return agents
+
+    async def publish_data(self) -> None:
+        """Publish the data directory's current contents as a new version, if enabled."""
+        if self.data_store is None:
+            return
+        async with self._publish_lock:
+            pinned = frozenset(
+                conn.data_version for conn in self.connections if conn.data_version
+            )
+            await trio.to_thread.run_sync(self.data_store.publish, pinned)
+        if (
+            self._versioned_compiler is not None
+            and self._versioned_compiler[0] != self.data_store.current_version
+        ):
+            self._retire_versioned_compiler()
+        for version in list(self._versioned_data_managers):
+            if not self.data_store.has_version(version):
+                del self._versioned_data_managers[version]
+
     async def _purge_command_log(self) -> None:
         """Periodically purge the event log"""
         if not self.config.command_log_purge_interval:
             return
         while True:
-            await self.command_log.purge(self.config.command_log_max_age)
+            deleted = await self.command_log.purge(
+                self.config.command_log_max_age,
+                self.config.command_log_max_rows,
+                self.config.command_log_max_size,
+            )
+            if deleted:
+                logger.info("Purged %d commands from the command log", deleted)
+            if self.command_archive is not None:
+                deleted = await trio.to_thread.run_sync(
+                    self.command_archive.purge, self.config.command_archive_max_age
+                )
+                if deleted:
+                    logger.info("Purged %d commands from the command archive", deleted)
             await trio.sleep(self.config.command_log_purge_interval)
 
     async def shutdown(self) -> None:
@@ -168,6 +343,12 @@ class Manager:
         for conn in self.connections:
             await conn.conn.bye("server shutting down")
             await conn.conn.close()
+        if self.state_compiler is not None:
+            self.state_compiler.shutdown()
+        if self._versioned_compiler is not None:
+            self._versioned_compiler[1].shutdown()
+        self.file_handle_cache.close()
+        await trio.to_thread.run_sync(self.command_log.close)
         self._cancel_scope.cancel()
 
 
@@ -186,11 +367,25 @@ class AgentConnection:
     agent_id: str | None
     """Agent ID"""
 
+    data_version: str | None
+    """The version of the data that the agent is pinned to, if data snapshots are enabled"""
+
     def __init__(self, stream: trio.SSLStream, manager: Manager):
         self.config = manager.config
         self.manager = manager
         self.conn = Connection(self.config, stream)
         self.agent_id = None
+        self.data_version = None
+
+    @property
+    def async_data_manager(self) -> AsyncDataManager:
+        """The data manager for the version of the data the agent is pinned to"""
+        return self.manager.get_async_data_manager(self.data_version)
+
+    def pin_data_version(self) -> None:
+        """Pin the agent to the currently published version of the data."""
+        if self.manager.data_store is not None:
+            self.data_version = self.manager.data_store.current_version
 
     async def run(self) -> None:
         await self.handshake()
@@ -205,7 +400,7 @@ class AgentConnection:
         machine_id = message.id
 
         success = False
-        entry = self.manager.data_manager.get_agent_entry(machine_id)
+        entry = await self.manager.async_data_manager.get_agent_entry(machine_id)
         ip_allowed = False
         ipaddr = ipaddress.ip_address(self.conn.remote_address[0])
         allowed_ips = entry.get("allowed_ips", [])
@@ -256,6 +451,7 @@ class AgentConnection:
             machine_id,
         )
         self.agent_id = machine_id
+        self.pin_data_version()
 
         res = ManagerHello(version=__version__)
         logger.debug("Returning server hello to %s", self.agent_id)
@@ -304,6 +500,7 @@ class AgentConnection:
         assert self.agent_id is not None
         logger.debug("Sending command %s to %s", command, self.agent_id)
         command_id = uuid.uuid4().hex
+        self.pin_data_version()
         await self.conn.rpc.call(
             "command", id=command_id, cmdtype=command, args=args, kwargs=kwargs
         )
@@ -344,6 +541,14 @@ class AgentConnection:
             changed,
             output,
         )
+        fingerprint = response.data.get("fingerprint")
+        if success and fingerprint is not None:
+            await self.manager.applied_states.state_applied(
+                self.agent_id,
+                response.data.get("state") or "",
+                fingerprint,
+                time.time(),
+            )
         await self.manager.event_bus.post(
             type="command_result",
             agent=self.agent_id,
@@ -359,11 +564,8 @@ class AgentConnection:
             await handler(result)
 
     async def custom_request(self, custom_request_name: str, *args, **kw) -> Callable:
-        try:
-            module = importlib.import_module(
-                f"redpepper.requests.{custom_request_name}"
-            )
-        except ImportError:
+        module = self.manager.get_builtin_request_module(custom_request_name)
+        if module is None:
             try:
                 assert self.agent_id is not None
                 module = self.manager.data_manager.get_request_module(
@@ -0,0 +1,155 @@
+"""Immutable, content-addressed snapshots of the Manager's data directory"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class DataStore:
+    """A store of immutable versions of a data directory.
+
+    Each file's contents are stored once under objects/ named by their SHA-256 digest.
+    Each published version is a directory tree under versions/ made of hard links
+    to those objects, so identical files (even in different groups or versions)
+    take up space only once, and a version's files never change once published.
+    """
+
+    def __init__(self, base_dir: pathlib.Path, source_dir: pathlib.Path, keep: int):
+        self.base_dir = base_dir
+        self.source_dir = source_dir
+        self.keep = keep
+        self.objects_dir = base_dir / "objects"
+        self.versions_dir = base_dir / "versions"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.versions_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._digests: dict[str, tuple[int, int, str]] = {}
+        try:
+            self.current_version: str | None = os.readlink(base_dir / "current")
+        except FileNotFoundError:
+            self.current_version = None
+
+    def get_version_dir(self, version: str) -> pathlib.Path:
+        """Get the directory containing the files of the version."""
+        return self.versions_dir / version
+
+    def has_version(self, version: str) -> bool:
+        return (self.versions_dir / version).is_dir()
+
+    def get_object_path(self, digest: str) -> pathlib.Path:
+        return self.objects_dir / digest[:2] / digest[2:]
+
+    def publish(self, pinned: frozenset[str] = frozenset()) -> str:
+        """Publish the current contents of the source directory as a new version.
+        Returns the version ID, which is the same as an existing version's
+        if nothing has changed. Old versions are removed except for the most
+        recent ones and those in pinned.
+        """
+        with self._lock:
+            manifest = {}
+            for relpath, path in self._walk_source():
+                try:
+                    manifest[relpath] = self._store_file(relpath, path)
+                except FileNotFoundError:
+                    logger.debug("File removed while publishing: %s", path)
+            version = hashlib.sha256(
+                json.dumps(manifest, sort_keys=True).encode()
+            ).hexdigest()[:16]
+            if not self.has_version(version):
+                self._create_version(version, manifest)
+            else:
+                # Mark the version as the most recently published one
+                os.utime(self.versions_dir / f"{version}.json")
+            link = self.base_dir / ".current.tmp"
+            link.unlink(missing_ok=True)
+            os.symlink(version, link)
+            os.replace(link, self.base_dir / "current")
+            if version != self.current_version:
+                logger.info("Published data version %s", version)
+            self.current_version = version
+            self._collect_garbage(pinned | {version})
+            return version
+
+    def _walk_source(self):
+        for dirpath, dirnames, filenames in os.walk(self.source_dir, followlinks=True):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            reldir = os.path.relpath(dirpath, self.source_dir)
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(dirpath, filename)
+                if os.path.isfile(path):
+                    yield os.path.normpath(os.path.join(reldir, filename)), path
+
+    def _store_file(self, relpath: str, path: str) -> str:
+        """Store the file's contents as an object if needed and return its digest."""
+        stat = os.stat(path)
+        cached = self._digests.get(relpath)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            if self.get_object_path(cached[2]).exists():
+                return cached[2]
+        # Copy the file while hashing it so that the digest always matches the copy
+        hash = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, prefix=".tmp-")
+        try:
+            with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                while chunk := src.read(1024 * 1024):
+                    hash.update(chunk)
+                    dst.write(chunk)
+            digest = hash.hexdigest()
+            object_path = self.get_object_path(digest)
+            if object_path.exists():
+                os.remove(tmp_path)
+            else:
+                os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                os.chmod(tmp_path, 0o444)
+                object_path.parent.mkdir(exist_ok=True)
+                os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._digests[relpath] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def _create_version(self, version: str, manifest: dict[str, str]) -> None:
+        tmp_dir = pathlib.Path(tempfile.mkdtemp(dir=self.versions_dir, prefix=".tmp-"))
+        try:
+            for relpath, digest in manifest.items():
+                path = tmp_dir / relpath
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.link(self.get_object_path(digest), path)
+            with open(self.versions_dir / f"{version}.json", "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_dir, self.versions_dir / version)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def _collect_garbage(self, keep: frozenset[str]) -> None:
+        manifests = sorted(
+            self.versions_dir.glob("*.json"),
+            key=lambda p: p.stat().st_mtime_ns,
+            reverse=True,
+        )
+        keep = keep | {p.stem for p in manifests[: self.keep]}
+        referenced = set()
+        for manifest_path in manifests:
+            version = manifest_path.stem
+            if version in keep:
+                with open(manifest_path) as f:
+                    referenced.update(json.load(f).values())
+                continue
+            logger.debug("Removing data version %s", version)
+            shutil.rmtree(self.versions_dir / version, ignore_errors=True)
+            manifest_path.unlink()
+        for object_path in self.objects_dir.glob("*/*"):
+            if object_path.parent.name + object_path.name not in referenced:
+                object_path.unlink()
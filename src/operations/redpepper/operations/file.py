@@ -1,4 +1,3 @@
-import base64
 import grp
 import hashlib
 import io
@@ -107,9 +106,7 @@ class Installed(Operation):
                 nwritten = len(shouldbe)
                 return nwritten, None
             return None, None
-        remote_stat = await agent.conn.rpc.call(
-            "custom", "dataFileStat", path=self.source
-        )
+        remote_stat = await agent.get_data_file_stat(self.source)
         if self.method == "stat":
             try:
                 existing_stat = os.fstat(f.fileno())
@@ -132,7 +129,7 @@ class Installed(Operation):
                 or existing_size != remote_stat["size"]
             )
         elif self.method == "hash":
-            hash = await agent.conn.rpc.call("custom", "dataFileHash", path=self.source)
+            hash = await agent.get_data_file_hash(self.source)
             existing_hash = self.hash_file(f)
             logger.debug("Hash of %s: %s vs. %s", self.path, existing_hash, hash)
             rewrite = existing_hash != hash
@@ -142,14 +139,9 @@ class Installed(Operation):
         # leave the file in an inconsistent state if the connection is lost
         contents = io.BytesIO()
         while True:
-            data = await agent.conn.rpc.call(
-                "custom",
-                "dataFileContents",
-                filename=self.source,
-                offset=contents.tell(),
-                length=32 * 1024,
+            data = await agent.get_data_file_contents(
+                self.source, contents.tell(), 32 * 1024
             )
-            data = base64.b64decode(data)
             if not data:
                 break
             contents.write(data)
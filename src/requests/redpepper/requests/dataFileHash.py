@@ -1,6 +1,3 @@
-import hashlib
-from typing import BinaryIO
-
 from redpepper.manager.manager import AgentConnection
 from redpepper.requests import RequestError
 
@@ -8,20 +5,15 @@ from redpepper.requests import RequestError
 async def call(conn: AgentConnection, path: str):
     assert conn.agent_id
     try:
-        fullpath = conn.manager.data_manager.get_data_file_path(conn.agent_id, path)
+        fullpath = await conn.async_data_manager.get_data_file_path(conn.agent_id, path)
     except ValueError as e:
         raise RequestError(str(e)) from e
     except FileNotFoundError:
         raise RequestError(f"File not found: {path}")
     try:
-        hash = hashlib.sha256()
-        with open(fullpath, "rb") as f:
-            f: BinaryIO
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash.update(chunk)
+        return await conn.manager.digest_cache.get_digest(fullpath)
     except FileNotFoundError:
         raise RequestError(f"File not found: {path}")
-    return hash.hexdigest()
 
 
 call.__qualname__ = "request dataFileHash"
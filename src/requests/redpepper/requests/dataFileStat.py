@@ -7,7 +7,7 @@ from redpepper.requests import RequestError
 async def call(conn: AgentConnection, path: str):
     assert conn.agent_id
     try:
-        fullpath = conn.manager.data_manager.get_data_file_path(conn.agent_id, path)
+        fullpath = await conn.async_data_manager.get_data_file_path(conn.agent_id, path)
     except ValueError as e:
         raise RequestError(str(e)) from e
     except FileNotFoundError:
@@ -2,6 +2,7 @@ import base64
 import os
 from typing import BinaryIO
 
+from redpepper.manager.bundles import MAX_MODULE_SIZE
 from redpepper.manager.manager import AgentConnection
 from redpepper.requests import RequestError
 
@@ -25,7 +26,7 @@ async def call(
         f: BinaryIO
         mtime = os.fstat(f.fileno()).st_mtime
         data = f.read()
-    if len(data) > 32 * 1024:
+    if len(data) > MAX_MODULE_SIZE:
         raise RequestError(f"Operation module too large: {name}")
     return {
         "changed": True,
@@ -0,0 +1,30 @@
+import base64
+
+from redpepper.manager.manager import AgentConnection
+from redpepper.requests import RequestError
+
+# Bundles up to this size are sent in the response itself
+INLINE_SIZE = 256 * 1024
+
+
+async def call(
+    conn: AgentConnection,
+    state_name: str | None = None,
+    existing_hash: str | None = None,
+):
+    assert conn.agent_id
+    try:
+        hash, bundle = await conn.manager.state_bundles.build(
+            conn.async_data_manager, conn.agent_id, state_name
+        )
+    except ValueError as e:
+        raise RequestError(str(e)) from e
+    if hash == existing_hash:
+        return {"changed": False, "hash": hash}
+    response = {"changed": True, "hash": hash, "size": len(bundle)}
+    if len(bundle) <= INLINE_SIZE:
+        response["content"] = base64.b64encode(bundle).decode("utf-8")
+    return response
+
+
+call.__qualname__ = "request stateBundle"
@@ -0,0 +1,16 @@
+import base64
+
+from redpepper.manager.manager import AgentConnection
+from redpepper.requests import RequestError
+
+
+async def call(conn: AgentConnection, hash: str, offset: int, length: int):
+    assert conn.agent_id
+    try:
+        data = conn.manager.state_bundles.read(conn.agent_id, hash, offset, length)
+    except KeyError as e:
+        raise RequestError(f"State bundle no longer available: {hash}") from e
+    return base64.b64encode(data).decode("utf-8")
+
+
+call.__qualname__ = "request stateBundleContents"
@@ -1,15 +1,23 @@
+from redpepper.manager.compliance import get_state_fingerprint
 from redpepper.manager.manager import AgentConnection
 from redpepper.requests import RequestError
 
 
-async def call(conn: AgentConnection, state_name: str | None = None):
+async def call(
+    conn: AgentConnection, state_name: str | None = None, with_fingerprint: bool = False
+):
     assert conn.agent_id
     try:
-        state = conn.manager.data_manager.get_state_definition_for_agent(
+        state = await conn.async_data_manager.get_state_definition_for_agent(
             conn.agent_id, state_name
         )
     except ValueError as e:
         raise RequestError(str(e)) from e
+    if with_fingerprint:
+        fingerprint = await get_state_fingerprint(
+            conn.async_data_manager, conn.manager.digest_cache, conn.agent_id, state
+        )
+        return {"state": state, "fingerprint": fingerprint}
     return state
 
 
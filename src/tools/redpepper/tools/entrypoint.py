@@ -308,5 +308,32 @@ def install_login(
     install_login(username, config_file)
 
 
+@cli.command()
+def inventory_import(
+    agents_file: str = "/var/lib/redpepper/data/agents.yml",
+    inventory_file: str = "/var/lib/redpepper-manager/agents.sqlite",
+    replace: bool = False,
+):
+    """
+    Import agents from an agents.yml file into an SQLite agent inventory.
+    """
+    from .inventory import import_inventory
+
+    import_inventory(agents_file, inventory_file, replace)
+
+
+@cli.command()
+def inventory_export(
+    inventory_file: str = "/var/lib/redpepper-manager/agents.sqlite",
+    agents_file: str = "agents.yml",
+):
+    """
+    Export the agents in an SQLite agent inventory to an agents.yml file.
+    """
+    from .inventory import export_inventory
+
+    export_inventory(inventory_file, agents_file)
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,31 @@
+import typer
+import yaml
+
+from redpepper.manager.inventory import SQLiteInventory
+
+
+def import_inventory(agents_file: str, inventory_file: str, replace: bool):
+    with open(agents_file) as f:
+        entries = yaml.safe_load(f) or {}
+    if not isinstance(entries, dict) or not all(
+        isinstance(entry, dict) for entry in entries.values()
+    ):
+        typer.secho(f"{agents_file} is not a mapping of agent entries", fg="red")
+        raise typer.Exit(1)
+    inventory = SQLiteInventory(inventory_file)  # type: ignore
+    try:
+        inventory.set_entries(entries, replace=replace)
+    finally:
+        inventory.close()
+    typer.echo(f"Imported {len(entries)} agents into {inventory_file}")
+
+
+def export_inventory(inventory_file: str, agents_file: str):
+    inventory = SQLiteInventory(inventory_file)  # type: ignore
+    try:
+        entries = inventory.get_entries()
+    finally:
+        inventory.close()
+    with open(agents_file, "w") as f:
+        yaml.safe_dump(entries, f, sort_keys=False)
+    typer.echo(f"Exported {len(entries)} agents to {agents_file}")
@@ -0,0 +1,9 @@
+
+from redpepper.operations import Operation, Result
+
+
+class Hello(Operation):
+    def run(self, agent):
+        result = Result(self)
+        result += "Hello from the bundle"
+        return result
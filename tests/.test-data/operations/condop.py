@@ -0,0 +1,14 @@
+
+from redpepper.operations import Operation, Result
+
+
+class Say(Operation):
+    def __init__(self, text, changed=False):
+        self.text = text
+        self.changed = changed
+
+    def run(self, agent):
+        result = Result(self)
+        result.changed = self.changed
+        result += self.text
+        return result
@@ -23,6 +23,9 @@ defaults = {
     "bind_host": "localhost",
     "bind_port": 7051,
     "data_base_dir": get_data_manager().path,
+    "data_cache_dir": None,
+    "data_file_digest_cache_file": None,
+    "applied_states_file": None,
 }
 
 
@@ -0,0 +1,50 @@
+import json
+
+from redpepper.manager.archive import CommandArchive
+from redpepper.manager.eventlog import CommandLog
+
+
+async def test_command_archive(tmp_path):
+    archive = CommandArchive(tmp_path / "archive", segment_max_size=1)
+    log = CommandLog(tmp_path / "commands.sqlite", archive=archive)
+    log.PURGE_BATCH_SIZE = 4
+    try:
+        for i in range(20):
+            await log.command_started(
+                f"cmd{i:02}",
+                1000.0 + i,
+                f"agent{i % 2}",
+                json.dumps({"command": "state", "args": [], "kw": {}}),
+            )
+            await log.command_finished(
+                f"cmd{i:02}", 1, False, f"output {i}" * 50, finish_time=1000.5 + i
+            )
+        assert await log.purge(1e10, max_rows=5) == 15
+        commands, _ = await log.query(limit=100)
+        assert len(commands) == 5
+    finally:
+        log.close()
+
+    # The moved commands are kept in several segments
+    archive = CommandArchive(tmp_path / "archive", segment_max_size=1)
+    assert len(archive._segments) > 1
+    assert sum(segment["count"] for segment in archive._segments) == 15
+
+    ids = []
+    cursor = None
+    while True:
+        commands, cursor = archive.query(limit=4, cursor=cursor)
+        ids.extend(c["id"] for c in commands)
+        if cursor is None:
+            break
+    assert ids == [f"cmd{i:02}" for i in reversed(range(15))]
+    [command], _ = archive.query(agent="agent1", since=1013, until=1014)
+    assert command["id"] == "cmd13"
+    assert command["output"] == "output 13" * 50
+    assert command["duration"] == 0.5
+    commands, _ = archive.query(command="noop")
+    assert commands == []
+
+    # Segments older than the maximum age are deleted, except the current one
+    assert archive.purge(0) == 15 - archive._segments[-1]["count"]
+    assert len(archive._segments) == 1
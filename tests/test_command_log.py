@@ -0,0 +1,333 @@
+import json
+import os
+import sqlite3
+
+import pytest
+import trio
+
+from redpepper.manager.eventlog import CommandLog
+
+
+async def test_command_log(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite")
+    try:
+        for i in range(3):
+            await log.command_started(
+                f"cmd{i}", 1000.0 + i, "agent1", json.dumps({"command": "state"})
+            )
+        await log.command_progressed("cmd1", 1, 2)
+        await log.command_finished("cmd2", 1, True, "done")
+        commands = [command async for command in log.last(2)]
+        assert [c["id"] for c in commands] == ["cmd2", "cmd1"]
+        assert commands[0]["status"] == 1
+        assert commands[0]["output"] == "done"
+        assert commands[1]["progress_current"] == 1
+        assert commands[1]["progress_total"] == 2
+
+        await log.purge(0)
+        assert [command async for command in log.last(10)] == []
+    finally:
+        log.close()
+
+    # Queued writes are committed when the log is closed
+    log = CommandLog(tmp_path / "commands.sqlite")
+    await log.command_started("cmd3", 1003.0, "agent1", json.dumps({}))
+    log.close()
+    log = CommandLog(tmp_path / "commands.sqlite")
+    try:
+        assert [c["id"] async for c in log.last(10)] == ["cmd3"]
+    finally:
+        log.close()
+
+
+async def test_command_progress_in_memory(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite", progress_interval=3600)
+    db = sqlite3.connect(tmp_path / "commands.sqlite")
+
+    def saved_progress():
+        return db.execute(
+            "SELECT progress_current, progress_total FROM redpepper_commands"
+        ).fetchone()
+
+    try:
+        await log.command_started("cmd", 1000.0, "agent1", json.dumps({}))
+        for i in range(1, 4):
+            await log.command_progressed("cmd", i, 10)
+        [command] = [c async for c in log.last(1)]
+        assert (command["progress_current"], command["progress_total"]) == (3, 10)
+        # Progress is not saved until the interval is over
+        assert saved_progress() == (0, 0)
+
+        await log.command_finished("cmd", 1, False, "")
+        await log.flush()
+        assert log.get_progress("cmd") is None
+        assert saved_progress() == (3, 10)
+    finally:
+        log.close()
+        db.close()
+
+
+async def test_command_log_query(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite")
+    try:
+        for i in range(10):
+            await log.command_started(
+                f"cmd{i}",
+                1000.0 + i // 2,
+                f"agent{i % 2}",
+                json.dumps({"command": "state" if i % 3 else "noop.Noop"}),
+            )
+            await log.command_finished(f"cmd{i}", 1 if i % 4 else 2, False, "")
+
+        # Pages follow each other without gaps or duplicates
+        ids = []
+        cursor = None
+        while True:
+            commands, cursor = await log.query(limit=3, cursor=cursor)
+            ids.extend(c["id"] for c in commands)
+            if cursor is None:
+                break
+        assert ids == [f"cmd{i}" for i in reversed(range(10))]
+
+        commands, _ = await log.query(agent="agent1", status=1)
+        assert [c["id"] for c in commands] == ["cmd9", "cmd7", "cmd5", "cmd3", "cmd1"]
+        commands, _ = await log.query(command="noop.Noop", since=1001, until=1004)
+        assert [c["id"] for c in commands] == ["cmd6", "cmd3"]
+        with pytest.raises(ValueError):
+            await log.query(cursor="invalid")
+    finally:
+        log.close()
+
+
+def test_command_log_migration(tmp_path):
+    # A database from before schema versions were recorded
+    db = sqlite3.connect(tmp_path / "commands.sqlite")
+    db.executescript(CommandLog.MIGRATIONS[0])
+    db.execute(
+        "INSERT INTO redpepper_commands (id, time, agent, command, status, changed,"
+        " progress_current, progress_total, output) VALUES ('old', 1, 'a', '{}', 1, 0, 0, 0, 'hello')"
+    )
+    db.commit()
+    db.close()
+    CommandLog(tmp_path / "commands.sqlite").close()
+    db = sqlite3.connect(tmp_path / "commands.sqlite")
+    try:
+        assert db.execute("PRAGMA user_version").fetchone()[0] == len(
+            CommandLog.MIGRATIONS
+        )
+        assert db.execute("SELECT id, output FROM redpepper_commands").fetchall() == [
+            ("old", None)
+        ]
+    finally:
+        db.close()
+    # The output was moved to the table of compressed outputs
+    log = CommandLog(tmp_path / "commands.sqlite")
+    try:
+        assert trio.run(log.get_output, "old") == "hello"
+    finally:
+        log.close()
+
+
+async def test_command_output(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite")
+    db = sqlite3.connect(tmp_path / "commands.sqlite")
+    try:
+        output = "line of output\n" * 1000
+        await log.command_started("cmd", 1000.0, "agent1", json.dumps({}))
+        assert await log.get_output("cmd") is None
+        await log.command_finished("cmd", 1, False, output)
+
+        # Listing commands doesn't include their output
+        [command], _ = await log.query()
+        assert "output" not in command
+        assert await log.get_output("cmd") == output
+        [blob] = db.execute("SELECT output FROM redpepper_command_outputs").fetchone()
+        assert len(blob) < len(output) / 10
+
+        await log.purge(0)
+        assert await log.get_output("cmd") is None
+
+        # The output of an unknown or purged command is not kept
+        await log.command_finished("cmd", 1, False, "more output")
+        await log.command_finished("unknown", 1, False, "secret output")
+        assert await log.get_output("unknown") is None
+        assert db.execute(
+            "SELECT COUNT(*) FROM redpepper_command_outputs"
+        ).fetchone() == (0,)
+    finally:
+        log.close()
+        db.close()
+
+
+async def test_command_log_retention(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite")
+    log.PURGE_BATCH_SIZE = 7
+    db = sqlite3.connect(tmp_path / "commands.sqlite")
+    try:
+        assert db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        for i in range(50):
+            await log.command_started(f"cmd{i}", 1000.0 + i, "agent1", "{}")
+            await log.command_finished(f"cmd{i}", 1, False, os.urandom(4000).hex())
+
+        assert await log.purge(1e10, max_rows=30) == 20
+        commands, _ = await log.query(limit=100)
+        assert [c["id"] for c in commands] == [
+            f"cmd{i}" for i in reversed(range(20, 50))
+        ]
+        assert await log.get_output("cmd19") is None
+
+        size = await log.get_size()
+        await log.flush()
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        file_size = (tmp_path / "commands.sqlite").stat().st_size
+        await log.purge(1e10, max_size=size // 2)
+        assert await log.get_size() <= size // 2
+        commands, _ = await log.query(limit=100)
+        assert 0 < len(commands) < 30
+        assert commands[0]["id"] == "cmd49"
+        # The freed pages were returned to the file system
+        await log.flush()
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        assert db.execute("PRAGMA freelist_count").fetchone()[0] == 0
+        assert (tmp_path / "commands.sqlite").stat().st_size < file_size
+    finally:
+        log.close()
+        db.close()
+
+
+async def test_command_log_search(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite")
+    try:
+        outputs = [
+            "Setting up nginx\nE: dpkg was interrupted, you must run dpkg --configure -a",
+            "Nothing to do",
+            "dpkg: warning: files list file missing",
+        ]
+        for i, output in enumerate(outputs):
+            await log.command_started(f"cmd{i}", 1000.0 + i, f"agent{i}", "{}")
+            await log.command_finished(f"cmd{i}", 2, False, output)
+
+        commands, _ = await log.query(search='"dpkg was interrupted"')
+        assert [c["id"] for c in commands] == ["cmd0"]
+        assert commands[0]["snippets"] == [
+            "E: dpkg was interrupted, you must run dpkg --configure -a"
+        ]
+        commands, _ = await log.query(search="dpkg")
+        assert [c["id"] for c in commands] == ["cmd2", "cmd0"]
+        commands, _ = await log.query(search="dpkg", agent="agent2")
+        assert [c["id"] for c in commands] == ["cmd2"]
+        with pytest.raises(ValueError):
+            await log.query(search='"unterminated')
+
+        # Purged commands are removed from the index
+        await log.purge(1e10, max_rows=1)
+        commands, _ = await log.query(search="dpkg")
+        assert [c["id"] for c in commands] == ["cmd2"]
+        await log.purge(0)
+        assert await log.query(search="dpkg") == ([], None)
+        db = sqlite3.connect(tmp_path / "commands.sqlite")
+        assert (
+            db.execute(
+                "SELECT rowid FROM redpepper_command_output_search"
+                " WHERE redpepper_command_output_search MATCH 'dpkg'"
+            ).fetchall()
+            == []
+        )
+        db.close()
+    finally:
+        log.close()
+
+
+async def test_command_log_analytics(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite")
+    try:
+        day = 86400 * 20000
+        for i in range(20):
+            await log.command_started(
+                f"cmd{i}",
+                day + i,
+                f"agent{i % 2}",
+                json.dumps({"command": "state", "args": [f"state{i % 2}"], "kw": {}}),
+            )
+            # Durations 1 to 20
+            await log.command_finished(
+                f"cmd{i}", 2 if i == 0 else 1, False, "", finish_time=day + 2 * i + 1
+            )
+        await log.command_started("running", day + 86400, "agent0", "{}")
+
+        [command], _ = await log.query(agent="agent1", limit=1)
+        assert (command["finish_time"], command["duration"]) == (day + 39, 20)
+
+        [group] = await log.analytics()
+        assert group == {
+            "key": "state",
+            "count": 20,
+            "succeeded": 19,
+            "success_rate": 0.95,
+            "duration_avg": 10.5,
+            "duration_p50": 10,
+            "duration_p95": 19,
+            "duration_p99": 20,
+        }
+        groups = await log.analytics("agent")
+        assert [(g["key"], g["count"], g["duration_p50"]) for g in groups] == [
+            ("agent0", 10, 9),
+            ("agent1", 10, 10),
+        ]
+        groups = await log.analytics("state", since=day + 10)
+        assert [(g["key"], g["count"]) for g in groups] == [
+            ("state0", 5),
+            ("state1", 5),
+        ]
+        [group] = await log.analytics("day")
+        assert group["key"] == "2024-10-04"
+        with pytest.raises(ValueError):
+            await log.analytics("invalid")
+    finally:
+        log.close()
+
+
+async def test_command_log_export(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite")
+    log.EXPORT_PAGE_SIZE = 3
+    try:
+        for i in range(10):
+            await log.command_started(f"cmd{i}", 1000.0 + i, f"agent{i % 2}", "{}")
+            await log.command_finished(f"cmd{i}", 1, False, f"output {i}")
+        commands = [c async for c in log.export()]
+        assert [c["id"] for c in commands] == [f"cmd{i}" for i in reversed(range(10))]
+        assert commands[0]["output"] == "output 9"
+        commands = [c async for c in log.export(agent="agent0", until=1006)]
+        assert [c["id"] for c in commands] == ["cmd4", "cmd2", "cmd0"]
+    finally:
+        log.close()
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+async def test_command_log_write_errors(tmp_path):
+    log = CommandLog(tmp_path / "commands.sqlite")
+
+    def fail(db):
+        db.execute("UPDATE redpepper_commands SET agent = 'changed'")
+        raise ValueError("failed")
+
+    try:
+        await log.command_started("cmd1", 1000.0, "agent1", "{}")
+        log._write_with(fail)
+        await log.command_started("cmd2", 1001.0, "agent1", "{}")
+        # The failed write was undone without affecting the others
+        commands, _ = await log.query()
+        assert [(c["id"], c["agent"]) for c in commands] == [
+            ("cmd2", "agent1"),
+            ("cmd1", "agent1"),
+        ]
+
+        def stop(db):
+            raise SystemExit
+
+        log._write_with(stop)
+        with pytest.raises(RuntimeError):
+            await log.flush()
+    finally:
+        with pytest.raises(RuntimeError):
+            log.close()
@@ -0,0 +1,110 @@
+import pytest
+import trio
+
+from tests.agent import setup_agent
+from tests.data import get_data_manager
+from tests.manager import setup_manager
+
+
+@pytest.mark.parametrize("state_bundles", [False, True])
+async def test_compliance(nursery: trio.Nursery, tmp_path, state_bundles):
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("groups.yml", clear=False) as d:
+        d["compliance_agent"] = ["compliance_group"]
+    with datamanager.file("data/compliance_group/compliance.txt") as f:
+        f.write("version 1")
+    with datamanager.file("state/compliance_group/compliance.yml") as f:
+        f.write(f"""
+- Install:
+    type: file.Installed
+    path: {tmp_path / "out.txt"}
+    source: compliance.txt
+""")
+    datamanager.setup_agent("compliance_agent", "notasecret")
+    manager = setup_manager()
+    nursery.start_soon(manager.run)
+    await manager.running.wait()
+    agent = setup_agent(
+        {"agent_id": "compliance_agent", "state_bundles": state_bundles}
+    )
+    nursery.start_soon(agent.run)
+    await agent.connected.wait()
+
+    async def get_entry():
+        for entry in await manager.get_compliance("compliance"):
+            if entry["agent"] == "compliance_agent":
+                return entry
+        raise AssertionError("agent not listed")
+
+    async def run_state():
+        command_id = await manager.send_command(
+            "compliance_agent", "state", ("compliance",), {}
+        )
+        assert command_id is not None
+        result = await manager.await_command_result(command_id, timeout=5)
+        assert result.succeeded, result.output
+
+    try:
+        entry = await get_entry()
+        assert entry["changed"]
+        assert entry["applied_fingerprint"] is None
+
+        await run_state()
+        entry = await get_entry()
+        assert not entry["changed"]
+        assert entry["applied_fingerprint"] == entry["fingerprint"]
+
+        # Changing a file the state installs changes the desired state
+        with datamanager.file("data/compliance_group/compliance.txt") as f:
+            f.write("version 2")
+        entry = await get_entry()
+        assert entry["changed"]
+
+        await run_state()
+        assert not (await get_entry())["changed"]
+    finally:
+        await agent.shutdown()
+        await manager.shutdown()
+
+
+async def test_state_without_fingerprint(nursery: trio.Nursery, tmp_path, monkeypatch):
+    import redpepper.requests.stateDefinition
+
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("groups.yml", clear=False) as d:
+        d["old_manager_agent"] = ["old_manager_group"]
+    with datamanager.file("data/old_manager_group/old_manager.txt") as f:
+        f.write("hello")
+    with datamanager.file("state/old_manager_group/old_manager.yml") as f:
+        f.write(f"""
+- Install:
+    type: file.Installed
+    path: {tmp_path / "out.txt"}
+    source: old_manager.txt
+""")
+    datamanager.setup_agent("old_manager_agent", "notasecret")
+
+    # A manager from before state fingerprints rejects the option
+    plain_call = redpepper.requests.stateDefinition.call
+
+    async def old_call(conn, state_name=None):
+        return await plain_call(conn, state_name)
+
+    monkeypatch.setattr(redpepper.requests.stateDefinition, "call", old_call)
+    manager = setup_manager()
+    nursery.start_soon(manager.run)
+    await manager.running.wait()
+    agent = setup_agent({"agent_id": "old_manager_agent"})
+    nursery.start_soon(agent.run)
+    await agent.connected.wait()
+    try:
+        command_id = await manager.send_command(
+            "old_manager_agent", "state", ("old_manager",), {}
+        )
+        assert command_id is not None
+        result = await manager.await_command_result(command_id, timeout=5)
+        assert result.succeeded, result.output
+        assert (tmp_path / "out.txt").read_text() == "hello"
+    finally:
+        await agent.shutdown()
+        await manager.shutdown()
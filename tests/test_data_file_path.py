@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from redpepper.manager.data import DataFileIndex, DataManager
+from tests.data import get_data_manager
+
+
+@pytest.mark.parametrize("index_interval", [0, 60])
+def test_get_data_file_path(index_interval):
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("files/groups.yml") as d:
+        d["test1"] = ["group1", "group2"]
+    for group, name in [
+        ("group1", "a.txt"),
+        ("group1", "sub/b.txt"),
+        ("group2", "a.txt"),
+        ("group3", "c.txt"),
+    ]:
+        with datamanager.file(f"files/data/{group}/{name}") as f:
+            f.write(group)
+    base = datamanager.path / "files"
+    d = DataManager(base, data_file_index_interval=index_interval)
+    assert d.get_data_file_path("test1", "a.txt") == os.path.join(
+        base, "data", "group2", "a.txt"
+    )
+    assert d.get_data_file_path("test1", "/sub//b.txt") == os.path.join(
+        base, "data", "group1", "sub", "b.txt"
+    )
+    for name in ["c.txt", "sub", "/", "nonexistent.txt"]:
+        with pytest.raises(FileNotFoundError):
+            d.get_data_file_path("test1", name)
+    for name in ["../group3/c.txt", ".hidden", "a\\b"]:
+        with pytest.raises(ValueError):
+            d.get_data_file_path("test1", name)
+
+    # New files are found once the index is invalidated
+    with datamanager.file("files/data/group1/new.txt") as f:
+        f.write("new")
+    d.invalidate_data_file_index()
+    assert d.get_data_file_path("test1", "new.txt") == os.path.join(
+        base, "data", "group1", "new.txt"
+    )
+
+
+def test_data_file_index_symlink_loop(tmp_path):
+    (tmp_path / "group1" / "sub").mkdir(parents=True)
+    (tmp_path / "group1" / "sub" / "a.txt").write_text("a")
+    (tmp_path / "group1" / "sub" / "loop").symlink_to("..")
+    index = DataFileIndex(str(tmp_path), 60)
+    assert index.resolve(["group1"], "sub/a.txt") == os.path.join(
+        tmp_path, "group1", "sub", "a.txt"
+    )
+    assert index.resolve(["group1"], "sub/loop/sub/a.txt") is None
+    # Only the names that were found are cached
+    assert list(index._resolved) == [(("group1",), "sub/a.txt")]
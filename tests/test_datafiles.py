@@ -0,0 +1,50 @@
+import hashlib
+import os
+
+from redpepper.manager.datafiles import DigestCache, FileHandleCache
+
+
+async def test_digest_cache(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"hello" * 100000)
+    cache = DigestCache(tmp_path / "digests.sqlite")
+    digest = await cache.get_digest(str(path))
+    assert digest == hashlib.sha256(path.read_bytes()).hexdigest()
+    assert await cache.get_digest(str(path)) == digest
+
+    # The digest is persisted
+    stat = os.stat(path)
+    cache = DigestCache(tmp_path / "digests.sqlite")
+    row = cache.db.execute(
+        "SELECT size, mtime_ns, digest FROM redpepper_file_digests"
+        " WHERE device = ? AND inode = ?",
+        (stat.st_dev, stat.st_ino),
+    ).fetchone()
+    assert row == (stat.st_size, stat.st_mtime_ns, digest)
+    assert await cache.get_digest(str(path)) == digest
+
+    # Changing the file changes the digest
+    path.write_bytes(b"changed")
+    assert await cache.get_digest(str(path)) == hashlib.sha256(b"changed").hexdigest()
+
+
+async def test_file_handle_cache(tmp_path):
+    cache = FileHandleCache(max_size=1)
+    path1 = tmp_path / "file1.txt"
+    path1.write_bytes(b"0123456789")
+    path2 = tmp_path / "file2.txt"
+    path2.write_bytes(b"abcdefghij")
+    try:
+        assert await cache.read(str(path1), 0, 4) == b"0123"
+        assert await cache.read(str(path1), 8, 4) == b"89"
+        assert await cache.read(str(path1), 20, 4) == b""
+        assert await cache.read(str(path2), 2, 3) == b"cde"
+        assert list(cache._files) == [str(path2)]
+        # A replaced file is reopened
+        replacement = tmp_path / "replacement.txt"
+        replacement.write_bytes(b"replaced")
+        os.replace(replacement, path2)
+        assert await cache.read(str(path2), 0, 100) == b"replaced"
+    finally:
+        cache.close()
+    assert not cache._files
@@ -0,0 +1,151 @@
+import json
+
+import trio
+import trio.testing
+
+from redpepper.manager.eventlog import EventBus, EventConsumer
+
+
+def received(consumer: EventConsumer) -> list[str]:
+    return [event.data["name"] for event in consumer.take()]
+
+
+async def test_event_bus_filters():
+    bus = EventBus()
+    everything = bus.add_consumer()
+    progress = bus.add_consumer(types=["command_progress", "command_result"])
+    one_command = bus.add_consumer(commands=["cmd1"])
+    agent_results = bus.add_consumer(types=["command_result"], agents=["agent1"])
+
+    await bus.post(name="a", type="connected", ip="127.0.0.1")
+    await bus.post(name="b", type="command_progress", agent="agent1", id="cmd1")
+    await bus.post(name="c", type="command_progress", agent="agent2", id="cmd2")
+    await bus.post(name="d", type="command_result", agent="agent1", id="cmd2")
+    await bus.post(name="e", type="command_result", agent="agent1", id="cmd1")
+
+    assert received(everything) == ["a", "b", "c", "d", "e"]
+    assert received(progress) == ["b", "c", "d", "e"]
+    assert received(one_command) == ["b", "e"]
+    assert received(agent_results) == ["d", "e"]
+
+    # Recent events are replayed to new consumers if they match
+    late = bus.add_consumer(agents=["agent2"])
+    assert received(late) == ["c"]
+
+    bus.remove_consumer(one_command)
+    bus.remove_consumer(late)
+    assert "cmd1" not in bus._index["commands"]
+    assert "agent2" not in bus._index["agents"]
+    await bus.post(name="f", type="command_result", agent="agent1", id="cmd1")
+    assert received(agent_results) == ["f"]
+
+
+async def test_event_encoded_once():
+    bus = EventBus()
+    consumers = [bus.add_consumer() for _ in range(3)]
+    await bus.post(type="connected", ip="127.0.0.1")
+    events = [consumer.take()[0] for consumer in consumers]
+    assert all(event is events[0] for event in events)
+    assert json.loads(events[0].json) == events[0].data
+    assert events[1].json is events[0].json
+
+
+async def test_event_bus_resume():
+    bus = EventBus(replay_size=5)
+    for i in range(8):
+        await bus.post(name=str(i), type="command", id=f"cmd{i % 2}")
+    assert bus.last_seq == 8
+
+    # Events 4 to 8 are kept
+    consumer = bus.add_consumer(after=5)
+    assert [event.data["seq"] for event in consumer.take()] == [6, 7, 8]
+
+    consumer = bus.add_consumer(after=8)
+    assert consumer.take() == []
+    await bus.post(name="8", type="command_result", id="cmd0")
+    assert [event.data["seq"] for event in consumer.take()] == [9]
+
+    # Fell too far behind
+    consumer = bus.add_consumer(commands=["cmd1"], after=1)
+    gap, *events = [event.data for event in consumer.take()]
+    assert (gap["type"], gap["after"], gap["next"]) == ("gap", 1, 5)
+    assert [event["seq"] for event in events] == [6, 8]
+
+    # From before a restart
+    consumer = bus.add_consumer(after=100)
+    assert [event.data["type"] for event in consumer.take()] == ["gap"]
+
+
+async def test_event_bus_resume_long_replay():
+    bus = EventBus(replay_size=50)
+    bus.MAX_PENDING = 10
+    for i in range(30):
+        await bus.post(name=str(i), type="command", id="cmd")
+
+    # The replay is not limited by the queue size
+    consumer = bus.add_consumer(after=5)
+    assert [event.data["seq"] for event in consumer.take()] == list(range(6, 31))
+
+    # A gap raised later starts from where the consumer resumed
+    consumer = bus.add_consumer(after=25)
+    for i in range(11):
+        await bus.post(name=str(i), type="command", id="cmd")
+    gap, *events = consumer.take()
+    assert (gap.data["type"], gap.data["after"]) == ("gap", 25)
+    assert [event.data["seq"] for event in events] == [41]
+
+
+async def test_event_consumer_coalescing():
+    bus = EventBus()
+    bus.MAX_PENDING = 5
+    consumer = bus.add_consumer()
+    await bus.post(name="start", type="command", id="cmd1")
+    for i in range(100):
+        await bus.post(name=f"p{i}", type="command_progress", id=f"cmd{i % 2}")
+    await bus.post(name="result", type="command_result", id="cmd1")
+    # Only the latest progress of each command is kept
+    assert received(consumer) == ["start", "p98", "p99", "result"]
+
+    # A newer progress event moves to the end of the queue, keeping it in seq order
+    await bus.post(name="p0", type="command_progress", id="cmd2")
+    await bus.post(name="other", type="command", id="cmd3")
+    await bus.post(name="p1", type="command_progress", id="cmd2")
+    events = consumer.take()
+    assert [event.data["name"] for event in events] == ["other", "p1"]
+    assert [event.data["seq"] for event in events] == sorted(
+        event.data["seq"] for event in events
+    )
+
+    # Falling too far behind replaces the queue with a gap, keeping the results
+    await bus.post(name="r", type="command_result", id="cmd3")
+    for i in range(5):
+        await bus.post(name=f"c{i}", type="command", id=f"cmd{i}")
+    gap, result, event = consumer.take()
+    assert gap.data["type"] == "gap"
+    assert (gap.data["after"], gap.data["next"]) == (bus.last_seq - 6, bus.last_seq)
+    assert result.data["name"] == "r"
+    assert event.data["name"] == "c4"
+
+
+async def test_event_consumer_wait():
+    bus = EventBus()
+    consumer = bus.add_consumer()
+    batches = []
+
+    async def consume():
+        while True:
+            try:
+                batches.append([event.data["name"] for event in await consumer.get()])
+            except trio.EndOfChannel:
+                return
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(consume)
+        await trio.testing.wait_all_tasks_blocked()
+        await bus.post(name="a", type="connected")
+        await bus.post(name="b", type="connected")
+        await trio.testing.wait_all_tasks_blocked()
+        await bus.post(name="c", type="connected")
+        await trio.testing.wait_all_tasks_blocked()
+        bus.remove_consumer(consumer)
+    assert batches == [["a", "b"], ["c"]]
@@ -0,0 +1,101 @@
+import msgpack
+import pytest
+
+from redpepper.manager.data import DataManager
+from tests.data import get_data_manager
+
+
+def setup_interpolation_data():
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("data/agents.yml") as d:
+        d["test1"] = {"data": {"name": "agent-specific", "nested": {"a": 1}}}
+    with datamanager.yamlfile("data/groups.yml") as d:
+        d["test1"] = ["group1", "group2"]
+    with datamanager.yamlfile("data/data/group1.yml") as d:
+        d["name"] = "group1"
+        d["port"] = 80
+        d["nested"] = {"b": 2}
+        d["only1"] = "from group1"
+    with datamanager.yamlfile("data/data/group2.yml") as d:
+        d["port"] = 8080
+        d["list"] = [1, 2, 3]
+    return DataManager(datamanager.path / "data")
+
+
+def test_data_view_layers():
+    d = setup_interpolation_data()
+    view = d.get_data_view_for_agent("test1")
+    assert view.get("name") == "agent-specific"
+    assert view.get("port") == 8080
+    assert view.get("nested.a") == 1
+    assert view.get("nested.b") == 2
+    assert view.get("only1") == "from group1"
+    assert view.get("<agent_id>") == "test1"
+    assert view.get("<groups>") == ["group1", "group2"]
+    with pytest.raises(KeyError):
+        view.get("nonexistent")
+    with pytest.raises(KeyError):
+        view.get("port.nonexistent")
+    # Memoized lookups give the same results
+    assert view.get("port") == 8080
+    with pytest.raises(KeyError):
+        view.get("nonexistent")
+
+
+def test_interpolate_state():
+    datamanager = get_data_manager()
+    d = setup_interpolation_data()
+    with datamanager.file("data/state/group1.yml") as f:
+        f.write("""
+- Config:
+    type: file.Installed
+    path: /etc/${name}.conf
+    port: ${port}
+    list: ${list}
+    literal: ${{port}
+""")
+    with datamanager.file("data/state/group2.yml") as f:
+        f.write("[]")
+    state = d.get_state_definition_for_agent("test1")
+    assert state == [
+        {
+            "Config": {
+                "type": "file.Installed",
+                "path": "/etc/agent-specific.conf",
+                "port": 8080,
+                "list": [1, 2, 3],
+                "literal": "${port}",
+            }
+        }
+    ]
+    with datamanager.file("data/state/group2.yml") as f:
+        f.write("""
+- Broken:
+    type: noop.Noop
+    value: ${nonexistent}
+""")
+    with pytest.raises(ValueError, match="Interpolation failed"):
+        d.get_state_definition_for_agent("test1")
+    with datamanager.file("data/state/group2.yml") as f:
+        f.write("[]")
+
+
+def test_yaml_snapshot_cache(tmp_path):
+    datamanager = get_data_manager()
+    setup_interpolation_data()
+    d = DataManager(datamanager.path / "data", tmp_path)
+    assert d.load_yaml_file("data/group1.yml")["port"] == 80
+    assert len(list(tmp_path.iterdir())) == 1
+    # A new DataManager loads the data from the snapshot
+    d = DataManager(datamanager.path / "data", tmp_path)
+    for snapshot in tmp_path.iterdir():
+        with open(snapshot, "rb") as f:
+            mtime_ns, size, data = msgpack.unpackb(f.read())
+        with open(snapshot, "wb") as f:
+            f.write(msgpack.packb([mtime_ns, size, {"port": "from snapshot"}]))
+    assert d.load_yaml_file("data/group1.yml")["port"] == "from snapshot"
+    # Changing the file invalidates the snapshot
+    with datamanager.yamlfile("data/data/group1.yml") as y:
+        y["port"] = 81
+    d = DataManager(datamanager.path / "data", tmp_path)
+    assert d.load_yaml_file("data/group1.yml")["port"] == 81
@@ -0,0 +1,88 @@
+import hashlib
+
+import trio
+import yaml
+from typer.testing import CliRunner
+
+from redpepper.manager.data import DataManager
+from redpepper.manager.inventory import SQLiteInventory
+from redpepper.tools.entrypoint import cli
+from tests.agent import setup_agent
+from tests.manager import setup_manager
+
+
+def test_sqlite_inventory(tmp_path):
+    inventory = SQLiteInventory(tmp_path / "agents.sqlite")
+    inventory.set_entries(
+        {"agent1": {"data": {"name": "one"}}, "agent2": {"allowed_ips": []}}
+    )
+    d = DataManager(tmp_path, inventory=inventory)
+    assert d.get_agent_names() == ["agent1", "agent2"]
+    assert d.get_agent_entry("agent1") == {"data": {"name": "one"}}
+    assert d.get_agent_entry("agent3") == {}
+    assert d.get_agent_entry("invalid id") == {}
+    assert d.get_data_for_agent("agent1", "name") == "one"
+
+    inventory.set_entries({"agent3": {}}, replace=True)
+    assert d.get_agent_names() == ["agent3"]
+    inventory.remove_agent("agent3")
+    assert d.get_agent_names() == []
+
+
+def test_inventory_import_export(tmp_path):
+    entries = {"agent1": {"secret_hash": "abc"}, "agent2": {"data": {"x": [1, 2]}}}
+    (tmp_path / "agents.yml").write_text(yaml.safe_dump(entries))
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "inventory-import",
+            "--agents-file",
+            str(tmp_path / "agents.yml"),
+            "--inventory-file",
+            str(tmp_path / "agents.sqlite"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(
+        cli,
+        [
+            "inventory-export",
+            "--inventory-file",
+            str(tmp_path / "agents.sqlite"),
+            "--agents-file",
+            str(tmp_path / "exported.yml"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert yaml.safe_load((tmp_path / "exported.yml").read_text()) == entries
+
+
+async def test_agent_auth_with_sqlite_inventory(nursery: trio.Nursery, tmp_path):
+    inventory = SQLiteInventory(tmp_path / "agents.sqlite")
+    inventory.set_entries(
+        {
+            "inventory_agent": {
+                "secret_hash": hashlib.sha256(b"notasecret").hexdigest(),
+                "allowed_ips": ["127.0.0.1/32", "::1/128"],
+            }
+        }
+    )
+    inventory.close()
+    manager = setup_manager(
+        {
+            "agent_inventory": "sqlite",
+            "agent_inventory_file": tmp_path / "agents.sqlite",
+        }
+    )
+    nursery.start_soon(manager.run)
+    await manager.running.wait()
+    agent = setup_agent({"agent_id": "inventory_agent"})
+    nursery.start_soon(agent.run)
+    try:
+        with trio.fail_after(5):
+            await agent.connected.wait()
+        assert "inventory_agent" in await manager.async_data_manager.get_agent_names()
+    finally:
+        await agent.shutdown()
+        await manager.shutdown()
@@ -103,3 +103,15 @@ def test_merge_state():
     type: test.ten
 """)
     assert state == combined
+    # The loaded source data must not be modified by merging
+    assert d.load_yaml_file("state/group1.yml")[0] == {
+        "One": [
+            {
+                "Two": [
+                    {"Three": {"type": "test.three"}},
+                    {"Four": {"type": "test.four"}},
+                ]
+            }
+        ]
+    }
+    assert d.get_state_definition_for_agent("test1") == combined
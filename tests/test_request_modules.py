@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from redpepper.manager.data import DataManager
+from tests.manager import setup_manager
+
+
+@pytest.mark.parametrize("index_interval", [0, 60])
+def test_request_modules_shared(tmp_path, index_interval):
+    (tmp_path / "requests" / "group1").mkdir(parents=True)
+    (tmp_path / "requests" / "group2").mkdir(parents=True)
+    (tmp_path / "groups.yml").write_text("'*': [group1]\nagent2: [group2]\n")
+    (tmp_path / "requests" / "group1" / "hello.py").write_text("value = 1\n")
+    d = DataManager(tmp_path, data_file_index_interval=index_interval)
+
+    module = d.get_request_module("agent1", "hello")
+    assert module.value == 1
+    # Agents using the same file share the module
+    assert d.get_request_module("agent3", "hello") is module
+    with pytest.raises(ImportError):
+        d.get_request_module("agent1", "missing")
+
+    # A module in a later group takes precedence
+    (tmp_path / "requests" / "group2" / "hello.py").write_text("value = 2\n")
+    d.invalidate_data_file_index()
+    assert d.get_request_module("agent2", "hello").value == 2
+    assert d.get_request_module("agent1", "hello") is module
+
+    # A changed file is loaded again
+    path = tmp_path / "requests" / "group1" / "hello.py"
+    path.write_text("value = 10\n")
+    os.utime(path, ns=(0, 0))
+    assert d.get_request_module("agent1", "hello").value == 10
+
+
+def test_builtin_request_modules():
+    manager = setup_manager()
+    assert manager.get_builtin_request_module("noop") is not None
+    assert manager.get_builtin_request_module("custom_thing") is None
+    assert "custom_thing" in manager._non_builtin_requests
+    assert manager.get_builtin_request_module("../noop") is None
+
+    # Only the most recently used names are remembered
+    manager.MAX_NON_BUILTIN_REQUESTS = 2
+    for name in ["custom_a", "custom_b", "custom_thing", "custom_c"]:
+        assert manager.get_builtin_request_module(name) is None
+    assert list(manager._non_builtin_requests) == ["custom_thing", "custom_c"]
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+import trio
+
+from redpepper.manager.asyncdata import SingleFlight
+
+
+async def test_single_flight_coalesces_calls():
+    single_flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def work(value):
+        calls.append(value)
+        release.wait()
+        return value * 2
+
+    results = []
+
+    async def call():
+        results.append(await single_flight.run_sync_in_thread("key", work, 21))
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(5):
+            nursery.start_soon(call)
+        await trio.sleep(0.1)
+        release.set()
+    assert calls == [21]
+    assert results == [42] * 5
+
+    # Once the call is done, the next call runs again
+    assert await single_flight.run_sync_in_thread("key", work, 1) == 2
+    assert calls == [21, 1]
+
+
+async def test_single_flight_propagates_errors():
+    single_flight = SingleFlight()
+
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError, match="failed"):
+        await single_flight.run_sync_in_thread("key", fail)
@@ -0,0 +1,129 @@
+import os
+
+import trio
+
+from redpepper.manager.snapshots import DataStore
+from tests.agent import setup_agent
+from tests.data import get_data_manager
+from tests.manager import setup_manager
+
+
+def test_publish_versions(tmp_path):
+    source = tmp_path / "source"
+    (source / "data" / "group1").mkdir(parents=True)
+    (source / "data" / "group2").mkdir(parents=True)
+    (source / "data" / "group1" / "file.txt").write_text("same")
+    (source / "data" / "group2" / "file.txt").write_text("same")
+    (source / "groups.yml").write_text("'*': [group1]\n")
+    (source / ".hidden").write_text("hidden")
+    store = DataStore(tmp_path / "store", source, keep=2)
+
+    version1 = store.publish()
+    assert store.current_version == version1
+    vdir = store.get_version_dir(version1)
+    assert (vdir / "groups.yml").read_text() == "'*': [group1]\n"
+    assert not (vdir / ".hidden").exists()
+    # Identical files are stored once
+    assert (
+        os.stat(vdir / "data" / "group1" / "file.txt").st_ino
+        == os.stat(vdir / "data" / "group2" / "file.txt").st_ino
+    )
+    # Publishing again without changes gives the same version
+    assert store.publish() == version1
+
+    # Changes create a new version and leave the old one untouched
+    (source / "data" / "group1" / "file.txt").write_text("changed")
+    version2 = store.publish()
+    assert version2 != version1
+    assert (vdir / "data" / "group1" / "file.txt").read_text() == "same"
+    assert (
+        store.get_version_dir(version2) / "data" / "group1" / "file.txt"
+    ).read_text() == "changed"
+
+    # Old versions are removed unless pinned
+    (source / "groups.yml").write_text("'*': [group2]\n")
+    version3 = store.publish(frozenset({version1}))
+    (source / "groups.yml").write_text("'*': [group1, group2]\n")
+    version4 = store.publish()
+    assert not store.has_version(version1)
+    assert not store.has_version(version2)
+    assert store.has_version(version3)
+    assert store.has_version(version4)
+    # Objects no longer referenced are removed
+    assert len(list(store.objects_dir.glob("*/*"))) == 4
+
+    # A new store picks up the current version
+    assert DataStore(tmp_path / "store", source, keep=2).current_version == version4
+
+
+async def test_agent_uses_published_data(nursery: trio.Nursery, tmp_path):
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("groups.yml", clear=False) as d:
+        d["snapshot_agent"] = ["snapshot_group"]
+    with datamanager.yamlfile("data/snapshot_group.yml") as d:
+        d["value"] = "published"
+    datamanager.setup_agent("snapshot_agent", "notasecret")
+    manager = setup_manager({"data_snapshots_dir": tmp_path})
+    nursery.start_soon(manager.run)
+    await manager.running.wait()
+    agent = setup_agent({"agent_id": "snapshot_agent"})
+    nursery.start_soon(agent.run)
+    await agent.connected.wait()
+
+    async def show_value():
+        command_id = await manager.send_command(
+            "snapshot_agent", "data.Show", (), {"name": "value"}
+        )
+        assert command_id is not None
+        result = await manager.await_command_result(command_id, timeout=5)
+        assert result.succeeded
+        return result.output
+
+    try:
+        assert "published" in await show_value()
+        with datamanager.yamlfile("data/snapshot_group.yml") as d:
+            d["value"] = "unpublished"
+        assert "unpublished" not in await show_value()
+        await manager.publish_data()
+        assert "unpublished" in await show_value()
+    finally:
+        await agent.shutdown()
+        await manager.shutdown()
+
+
+async def test_published_data_compiled_in_workers(nursery: trio.Nursery, tmp_path):
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("groups.yml", clear=False) as d:
+        d["snapshot_compile_agent"] = ["snapshot_compile_group"]
+    with datamanager.file("state/snapshot_compile_group/hello.yml") as f:
+        f.write("- Hello:\n    type: echo.Echo\n    message: one\n")
+    manager = setup_manager(
+        {"data_snapshots_dir": tmp_path, "state_compile_workers": 1}
+    )
+    nursery.start_soon(manager.run)
+    await manager.running.wait()
+    try:
+        await manager.publish_data()
+        version1 = manager.data_store.current_version
+        data_manager1 = manager.get_async_data_manager(version1)
+        assert data_manager1.compiler is not None
+        state = await data_manager1.get_state_definition_for_agent(
+            "snapshot_compile_agent", "hello"
+        )
+        assert state[0]["Hello"]["message"] == "one"
+
+        # Only the current version is compiled in the workers
+        with datamanager.file("state/snapshot_compile_group/hello.yml") as f:
+            f.write("- Hello:\n    type: echo.Echo\n    message: two\n")
+        await manager.publish_data()
+        data_manager2 = manager.get_async_data_manager(
+            manager.data_store.current_version
+        )
+        assert data_manager2.compiler is not None
+        assert data_manager1.compiler is None
+        state = await data_manager2.get_state_definition_for_agent(
+            "snapshot_compile_agent", "hello"
+        )
+        assert state[0]["Hello"]["message"] == "two"
+    finally:
+        await manager.shutdown()
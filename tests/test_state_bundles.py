@@ -0,0 +1,180 @@
+import types
+
+import pytest
+import trio
+
+from redpepper.manager.bundles import MAX_MODULE_SIZE, StateBundleCache
+from tests.agent import setup_agent
+from tests.data import get_data_manager
+from tests.manager import setup_manager
+
+
+async def test_state_bundle(nursery: trio.Nursery, tmp_path):
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("groups.yml", clear=False) as d:
+        d["bundle_agent"] = ["bundle_group"]
+    with datamanager.file("data/bundle_group/bundle.txt") as f:
+        f.write("bundled contents")
+    with datamanager.file("operations/bundleop.py") as f:
+        f.write("""
+from redpepper.operations import Operation, Result
+
+
+class Hello(Operation):
+    def run(self, agent):
+        result = Result(self)
+        result += "Hello from the bundle"
+        return result
+""")
+    with datamanager.file("state/bundle_group/bundle.yml") as f:
+        f.write(f"""
+- Install:
+    type: file.Installed
+    path: {tmp_path / "out.txt"}
+    source: bundle.txt
+- Hello:
+    type: bundleop.Hello
+""")
+    datamanager.setup_agent("bundle_agent", "notasecret")
+    manager = setup_manager()
+    nursery.start_soon(manager.run)
+    await manager.running.wait()
+    cache_dir = tmp_path / "operations"
+    cache_dir.mkdir()
+    agent = setup_agent(
+        {
+            "agent_id": "bundle_agent",
+            "state_bundles": True,
+            "operation_modules_cache_dir": cache_dir,
+        }
+    )
+    nursery.start_soon(agent.run)
+    await agent.connected.wait()
+    requests = []
+    rpc_call = agent.conn.rpc.call
+
+    async def call(method, *args, **kwargs):
+        requests.append(args[0] if method == "custom" else method)
+        return await rpc_call(method, *args, **kwargs)
+
+    agent.conn.rpc.call = call
+
+    async def run_state():
+        command_id = await manager.send_command(
+            "bundle_agent", "state", ("bundle",), {}
+        )
+        assert command_id is not None
+        result = await manager.await_command_result(command_id, timeout=5)
+        assert result.succeeded, result.output
+        return result.output
+
+    try:
+        output = await run_state()
+        assert "Hello from the bundle" in output
+        assert (tmp_path / "out.txt").read_text() == "bundled contents"
+        assert requests == ["stateBundle"]
+        bundle_hash = agent.state_bundles["bundle"]["hash"]
+
+        # The unchanged bundle is reused
+        output = await run_state()
+        assert "already in the specified state" in output
+        assert requests == ["stateBundle", "stateBundle"]
+        assert agent.state_bundles["bundle"]["hash"] == bundle_hash
+
+        # Bundles are only served to the agent they were built for
+        assert manager.state_bundles.read("bundle_agent", bundle_hash, 0, 1)
+        with pytest.raises(KeyError):
+            manager.state_bundles.read("other_agent", bundle_hash, 0, 1)
+
+        # A changed data file changes the bundle
+        with datamanager.file("data/bundle_group/bundle.txt") as f:
+            f.write("new contents")
+        await run_state()
+        assert (tmp_path / "out.txt").read_text() == "new contents"
+        assert agent.state_bundles["bundle"]["hash"] != bundle_hash
+    finally:
+        await agent.shutdown()
+        await manager.shutdown()
+
+
+@pytest.mark.parametrize("state_bundles", [False, True])
+async def test_custom_operation_changed_condition(
+    nursery: trio.Nursery, tmp_path, state_bundles
+):
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("groups.yml", clear=False) as d:
+        d["condition_agent"] = ["condition_group"]
+    with datamanager.file("operations/condop.py") as f:
+        f.write("""
+from redpepper.operations import Operation, Result
+
+
+class Say(Operation):
+    def __init__(self, text, changed=False):
+        self.text = text
+        self.changed = changed
+
+    def run(self, agent):
+        result = Result(self)
+        result.changed = self.changed
+        result += self.text
+        return result
+""")
+    with datamanager.file("state/condition_group/condition.yml") as f:
+        f.write("""
+- Change:
+    type: condop.Say
+    text: change made
+    changed: true
+- Follow:
+    type: condop.Say
+    text: followed the change
+    if:
+      changed: Change
+- Skip:
+    type: condop.Say
+    text: should not run
+    if:
+      changed: Follow
+""")
+    datamanager.setup_agent("condition_agent", "notasecret")
+    manager = setup_manager()
+    nursery.start_soon(manager.run)
+    await manager.running.wait()
+    cache_dir = tmp_path / "operations"
+    cache_dir.mkdir()
+    agent = setup_agent(
+        {
+            "agent_id": "condition_agent",
+            "state_bundles": state_bundles,
+            "operation_modules_cache_dir": cache_dir,
+        }
+    )
+    nursery.start_soon(agent.run)
+    await agent.connected.wait()
+    try:
+        command_id = await manager.send_command(
+            "condition_agent", "state", ("condition",), {}
+        )
+        assert command_id is not None
+        result = await manager.await_command_result(command_id, timeout=5)
+        assert result.succeeded, result.output
+        assert "followed the change" in result.output
+        assert "should not run" not in result.output
+    finally:
+        await agent.shutdown()
+        await manager.shutdown()
+
+
+def test_state_bundle_module_size(tmp_path):
+    data_manager = types.SimpleNamespace(
+        data_manager=types.SimpleNamespace(
+            get_operation_module_path=lambda name: tmp_path / f"{name}.py"
+        )
+    )
+    (tmp_path / "small.py").write_text("pass\n")
+    (tmp_path / "large.py").write_text("#" * (MAX_MODULE_SIZE + 1))
+    assert StateBundleCache._read_module(data_manager, "small")["content"] == b"pass\n"
+    # Too large modules are left out for the agent to request and get the error
+    assert StateBundleCache._read_module(data_manager, "large") is None
+    assert StateBundleCache._read_module(data_manager, "missing") is None
@@ -0,0 +1,72 @@
+from redpepper.manager.compiler import StateCompiler
+from redpepper.manager.data import DataManager
+from tests.data import get_data_manager
+
+
+def test_compile_many_matches_data_manager():
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("compiler/agents.yml") as d:
+        d["agent1"] = {"data": {"name": "one"}}
+        d["agent2"] = {"data": {"name": "two"}}
+    with datamanager.yamlfile("compiler/groups.yml") as d:
+        d["agent*"] = ["group1"]
+        d["agent2"] = ["group2"]
+    with datamanager.file("compiler/state/group1.yml") as f:
+        f.write("""
+- Hello:
+    type: echo.Echo
+    message: Hello ${name}
+""")
+    with datamanager.file("compiler/state/group2.yml") as f:
+        f.write("""
+- Hello:
+    type: echo.Echo
+    message: Bye ${name}
+""")
+    d = DataManager(datamanager.path / "compiler")
+    compiler = StateCompiler(d, 2)
+    try:
+        results = compiler.compile_many(["agent1", "agent2"])
+        assert results == {
+            "agent1": d.get_state_definition_for_agent("agent1"),
+            "agent2": d.get_state_definition_for_agent("agent2"),
+        }
+        assert results["agent2"] == [
+            {"Hello": {"type": "echo.Echo", "message": "Bye two"}}
+        ]
+
+        # Changing a source file makes the compiler use the new data
+        with datamanager.file("compiler/state/group2.yml") as f:
+            f.write("""
+- Hello:
+    type: echo.Echo
+    message: Hi ${nonexistent}
+""")
+        assert compiler.compile("agent1") == results["agent1"]
+        results = compiler.compile_many(["agent2"])
+        assert isinstance(results["agent2"], ValueError)
+    finally:
+        compiler.shutdown()
+
+
+def test_compiler_check_interval():
+    datamanager = get_data_manager()
+    with datamanager.yamlfile("compiler_interval/agents.yml") as d:
+        d["agent1"] = {}
+    with datamanager.yamlfile("compiler_interval/groups.yml") as d:
+        d["agent1"] = ["group1"]
+    with datamanager.file("compiler_interval/state/group1.yml") as f:
+        f.write("- Hello:\n    type: echo.Echo\n    message: one\n")
+    d = DataManager(datamanager.path / "compiler_interval")
+    compiler = StateCompiler(d, 1, check_interval=60)
+    try:
+        assert compiler.compile("agent1")[0]["Hello"]["message"] == "one"
+
+        # Changes are only noticed after the interval or an invalidation
+        with datamanager.file("compiler_interval/state/group1.yml") as f:
+            f.write("- Hello:\n    type: echo.Echo\n    message: two\n")
+        assert compiler.compile("agent1")[0]["Hello"]["message"] == "one"
+        compiler.invalidate()
+        assert compiler.compile("agent1")[0]["Hello"]["message"] == "two"
+    finally:
+        compiler.shutdown()